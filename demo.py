@@ -13,6 +13,9 @@ import argparse
 import numpy as np
 from torch.multiprocessing import Process
 from droid import Droid
+from data_readers.prefetch import Prefetcher
+from data_readers.calibration import Calibration
+from functools import partial
 from scipy.spatial.transform import Rotation as R
 from lietorch import SE3
 import torch.nn.functional as F
@@ -46,37 +49,36 @@ def show_image(image):
     cv2.imshow('image', image / 255.0)
     cv2.waitKey(1)
 
-def image_stream(imagedir, calib, stride):
-    """ image generator """
+def load_image(imfile, calib):
+    """ read, undistort and resize one frame """
 
-    calib = np.loadtxt(calib, delimiter=" ")
-    fx, fy, cx, cy = calib[:4]
+    image = cv2.imread(imfile)
 
-    K = np.eye(3)
-    K[0,0] = fx
-    K[0,2] = cx
-    K[1,1] = fy
-    K[1,2] = cy
+    h0, w0, _ = image.shape
+    h1 = int(h0 * np.sqrt((384 * 512) / (h0 * w0)))
+    w1 = int(w0 * np.sqrt((384 * 512) / (h0 * w0)))
 
-    image_list = sorted(os.listdir(imagedir))[::stride]
+    # undistortion and resize in one remap
+    image = calib.remap(image, (h1, w1))
+    image = image[:h1-h1%8, :w1-w1%8]
+    image = torch.as_tensor(image).permute(2, 0, 1)
+
+    intrinsics = torch.as_tensor(calib.scaled((h0, w0), (h1, w1)))
 
-    for t, imfile in enumerate(image_list):
-        image = cv2.imread(os.path.join(imagedir, imfile))
-        if len(calib) > 4:
-            image = cv2.undistort(image, K, calib[4:])
+    return image, intrinsics
 
-        h0, w0, _ = image.shape
-        h1 = int(h0 * np.sqrt((384 * 512) / (h0 * w0)))
-        w1 = int(w0 * np.sqrt((384 * 512) / (h0 * w0)))
+def image_stream(imagedir, calib, stride, prefetch=0, workers=1, processes=False):
+    """ image generator, frames are decoded up to `prefetch` frames ahead of tracking """
 
-        image = cv2.resize(image, (w1, h1))
-        image = image[:h1-h1%8, :w1-w1%8]
-        image = torch.as_tensor(image).permute(2, 0, 1)
+    calib = Calibration.from_file(calib)
 
-        intrinsics = torch.as_tensor([fx, fy, cx, cy])
-        intrinsics[0::2] *= (w1 / w0)
-        intrinsics[1::2] *= (h1 / h0)
+    image_list = sorted(os.listdir(imagedir))[::stride]
+    image_list = [os.path.join(imagedir, imfile) for imfile in image_list]
 
+    frames = Prefetcher(partial(load_image, calib=calib), image_list,
+        depth=prefetch, workers=workers, processes=processes)
+
+    for t, (image, intrinsics) in enumerate(frames):
         yield t, image[None], intrinsics
 
 
@@ -88,7 +90,7 @@ def save_reconstruction(droid, reconstruction_path):
     init_data = np.array([0., 0., 0., 0., 0., 0., 1.])
     t = droid.video.counter.value
     tstamps = droid.video.tstamp[:t].cpu().numpy()
-    images = droid.video.images[:t].cpu().numpy()
+    images = droid.video.images[droid.video.slots[:t]].cpu().numpy()
     disps = droid.video.disps_up[:t].cpu().numpy()
     poses = droid.video.poses[:t].cpu().numpy()
     intrinsics = droid.video.intrinsics[:t].cpu().numpy()
@@ -158,26 +160,43 @@ if __name__ == '__main__':
     parser.add_argument("--calib", type=str, help="path to calibration file")
     parser.add_argument("--t0", default=0, type=int, help="starting frame")
     parser.add_argument("--stride", default=1, type=int, help="frame stride")
+    parser.add_argument("--prefetch", default=8, type=int, help="frames decoded ahead of tracking, 0 decodes in the main thread")
+    parser.add_argument("--prefetch_workers", default=2, type=int, help="number of decoding workers")
+    parser.add_argument("--prefetch_processes", action="store_true", help="decode in worker processes instead of threads")
 
     parser.add_argument("--weights", default="droid.pth")
-    parser.add_argument("--buffer", type=int, default=300)
+    parser.add_argument("--buffer", type=int, default=300, help="initial number of keyframes, grows as needed")
+    parser.add_argument("--resident_keyframes", type=int, default=-1, help="keyframe features kept on the device, the rest are spilled to disk")
+    parser.add_argument("--spill_dir", type=str, help="directory for spilled keyframe features")
+    parser.add_argument("--keep_features", action="store_true", help="keep features of all frames so the full trajectory is filled without reading the images again")
+    parser.add_argument("--resident_frames", type=int, default=-1, help="kept frame features held in memory, the rest are spilled to disk")
+    parser.add_argument("--fill_chunk", type=int, default=-1, help="frames per trajectory filling chunk, sized to free device memory if not set")
     parser.add_argument("--image_size", default=[240, 320])
     parser.add_argument("--disable_vis", action="store_true")
+    parser.add_argument("--device", default="cuda:0", help="device for tracking, e.g. cuda:0 or cpu")
 
     parser.add_argument("--beta", type=float, default=0.3, help="weight for translation / rotation components of flow")
     parser.add_argument("--filter_thresh", type=float, default=0, help="how much motion before considering new keyframe")
+    parser.add_argument("--prefilter_thresh", type=float, default=0, help="skip frames whose mean intensity difference to the last keyframe is below this")
+    parser.add_argument("--filter_batch", type=int, default=1, help="number of frames passed through the motion filter at once")
     parser.add_argument("--warmup", type=int, default=8, help="number of warmup frames")
     parser.add_argument("--keyframe_thresh", type=float, default=0, help="threshold to create a new keyframe")
     parser.add_argument("--frontend_thresh", type=float, default=16.0, help="add edges between frames whithin this distance")
     parser.add_argument("--frontend_window", type=int, default=25, help="frontend optimization window")
     parser.add_argument("--frontend_radius", type=int, default=2, help="force edges between frames within radius")
     parser.add_argument("--frontend_nms", type=int, default=1, help="non-maximal supression of edges")
+    parser.add_argument("--frontend_corr", default="volume", choices=["volume", "lazy"], help="precompute correlation volumes or compute them around the sampled coordinates")
+    parser.add_argument("--inactive_budget", type=float, default=-1, help="memory budget (MB) for inactive frontend factors")
+    parser.add_argument("--inactive_window", type=int, default=-1, help="drop inactive factors older than this many keyframes")
+    parser.add_argument("--corr_cache", type=float, default=-1, help="memory budget (MB) for correlation volumes of frontend factors that leave the graph, retired factors only qualify once evicted by --inactive_window or --inactive_budget")
 
     parser.add_argument("--backend_thresh", type=float, default=22.0)
     parser.add_argument("--backend_radius", type=int, default=2)
     parser.add_argument("--backend_nms", type=int, default=3)
     parser.add_argument("--upsample", action="store_true")
     parser.add_argument("--reconstruction_path", help="path to saved reconstruction")
+    parser.add_argument("--profile", action="store_true", help="collect per-stage timings and memory, printed on exit")
+    parser.add_argument("--profile_log", type=str, help="write per-frame profiling records to this jsonl file")
     args = parser.parse_args()
 
     args.stereo = False
@@ -193,7 +212,9 @@ if __name__ == '__main__':
         args.upsample = True
 
     tstamps = []
-    for (t, image, intrinsics) in tqdm(image_stream(args.imagedir, args.calib, args.stride)):
+    batch = []
+    for (t, image, intrinsics) in tqdm(image_stream(args.imagedir, args.calib, args.stride,
+            args.prefetch, args.prefetch_workers, args.prefetch_processes)):
         if t < args.t0:
             continue
 
@@ -204,10 +225,25 @@ if __name__ == '__main__':
             args.image_size = [image.shape[2], image.shape[3]]
             droid = Droid(args)
         
-        droid.track(t, image, intrinsics=intrinsics)
+        batch.append((t, image, intrinsics))
+        if len(batch) < args.filter_batch:
+            continue
+
+        tstamp, images, intrinsics = zip(*batch)
+        droid.track_batch(tstamp, images, intrinsics=intrinsics)
         print(droid.video.counter.value)
+        batch = []
+
+    if len(batch) > 0:
+        tstamp, images, intrinsics = zip(*batch)
+        droid.track_batch(tstamp, images, intrinsics=intrinsics)
     
-    traj_est_full = droid.get_full_est_traj(image_stream(args.imagedir, args.calib, args.stride))
+    stream = None
+    if not args.keep_features:
+        stream = image_stream(args.imagedir, args.calib, args.stride,
+            args.prefetch, args.prefetch_workers, args.prefetch_processes)
+
+    traj_est_full = droid.get_full_est_traj(stream)
     matrices = convert_to_4x4_matrix(traj_est_full)
 
     with open(os.path.join(output_dir, "full_trajectory_today.txt"), 'w') as f:
@@ -221,6 +257,8 @@ if __name__ == '__main__':
         save_reconstruction(droid, args.reconstruction_path)
         save_images_and_camera_info(droid, output_dir,traj_est_full)
 
+    droid.finish()
+
     # traj_est = droid.terminate(image_stream(args.imagedir, args.calib, args.stride))
     # if args.reconstruction_path is not None:
     #     save_reconstruction(droid, args.reconstruction_path)
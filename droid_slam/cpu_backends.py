@@ -0,0 +1,373 @@
+import torch
+import lietorch
+import numpy as np
+
+import scipy.sparse
+import scipy.sparse.linalg
+
+import geom.projective_ops as pops
+from geom.chol import group_pairs, block_diag_solve
+
+# pure pytorch versions of the droid_backends kernels, used when the video lives on the cpu
+
+# matches MIN_DEPTH in droid_kernels.cu
+MIN_DEPTH = 0.25
+
+# edge-pixels linearized at once, bounds the size of the jacobian tensors
+LINEARIZE_TILE = 2**20
+
+# number of E-row pairs reduced at once when forming the schur complement
+SCHUR_CHUNK = 1024
+
+# number of frame pairs evaluated at once by frame_distance
+DISTANCE_CHUNK = 256
+
+# number of pixels sampled at once by the correlation lookups
+CORR_CHUNK = 4096
+ALTCORR_CHUNK = 512
+
+
+def _sparse_solve(rows, cols, vals, b, n, lm=0.0001, ep=0.1):
+    """ solve block-sparse normal equations, mirrors SparseBlock::solve """
+
+    A = scipy.sparse.coo_matrix((vals.numpy(), (rows.numpy(), cols.numpy())), shape=(n, n)).tocsc()
+    A = A + scipy.sparse.diags(ep + lm * A.diagonal())
+
+    try:
+        x = scipy.sparse.linalg.splu(A, permc_spec="MMD_AT_PLUS_A").solve(b.numpy())
+    except RuntimeError:
+        return torch.zeros(n, dtype=torch.float64)
+
+    if not np.all(np.isfinite(x)):
+        return torch.zeros(n, dtype=torch.float64)
+
+    return torch.from_numpy(x)
+
+
+def _block_triplets(blocks, ii, jj, P, D=6):
+    """ expand [N, D, D] blocks at block positions (ii, jj) to coo triplets """
+
+    v = (ii >= 0) & (jj >= 0) & (ii < P) & (jj < P)
+    blocks, ii, jj = blocks[v], ii[v], jj[v]
+
+    d = torch.arange(D)
+    rows = (D * ii[:,None,None] + d[None,:,None]).expand_as(blocks)
+    cols = (D * jj[:,None,None] + d[None,None,:]).expand_as(blocks)
+    return rows.reshape(-1), cols.reshape(-1), blocks.reshape(-1)
+
+
+def _linearize(poses, disps, intrinsics, targets, weights, ii, jj):
+    """ per-edge jacobian blocks, matches projective_transform_kernel. jacobians are built
+        for tiles of pixel rows, as in geom.ba.linearize """
+
+    E, _, ht, wd = targets.shape
+    Gs = lietorch.SE3(poses[None])
+
+    rows = max(1, min(ht, LINEARIZE_TILE // max(1, E * wd)))
+
+    # stereo edges only constrain depth
+    s = (ii != jj).float()[:,None]
+
+    Hs = vs = 0.0
+    Eii, Eij, Cii, wi = [], [], [], []
+
+    for r0 in range(0, ht, rows):
+        r1 = min(ht, r0 + rows)
+        hw = (r1 - r0) * wd
+
+        # shift principal point so the tile is projected as a full image
+        shift = torch.as_tensor([0.0, 0.0, 0.0, r0], device=intrinsics.device)
+        coords, valid, (Ji, Jj, Jz) = pops.projective_transform(Gs, disps[None,:,r0:r1],
+            (intrinsics - shift).expand(poses.shape[0], 4)[None], ii, jj, jacobian=True, min_depth=MIN_DEPTH)
+
+        offset = torch.as_tensor([0.0, r0], device=coords.device)
+        r = (targets[:,:,r0:r1].permute(0,2,3,1) - offset - coords[0]).reshape(E, -1)
+        w = .001 * (valid[0] * weights[:,:,r0:r1].permute(0,2,3,1)).reshape(E, -1)
+
+        Ji = Ji.reshape(E, -1, 6)
+        Jj = Jj.reshape(E, -1, 6)
+        Jz = Jz.reshape(E, -1)
+        ws = w * s
+
+        Hs = Hs + torch.stack([
+            torch.einsum('nk,nki,nkj->nij', ws, Ji, Ji),
+            torch.einsum('nk,nki,nkj->nij', ws, Ji, Jj),
+            torch.einsum('nk,nki,nkj->nij', ws, Jj, Ji),
+            torch.einsum('nk,nki,nkj->nij', ws, Jj, Jj)])
+
+        vs = vs + torch.stack([
+            torch.einsum('nk,nk,nki->ni', ws, r, Ji),
+            torch.einsum('nk,nk,nki->ni', ws, r, Jj)])
+
+        # reduce u,v residuals per pixel
+        Eii.append(((ws * Jz)[...,None] * Ji).view(E, hw, 2, 6).sum(dim=2).transpose(1,2))
+        Eij.append(((ws * Jz)[...,None] * Jj).view(E, hw, 2, 6).sum(dim=2).transpose(1,2))
+
+        Cii.append((w * Jz * Jz).view(E, hw, 2).sum(dim=-1))
+        wi.append((w * r * Jz).view(E, hw, 2).sum(dim=-1))
+
+    return Hs, vs, torch.cat(Eii, -1), torch.cat(Eij, -1), torch.cat(Cii, -1), torch.cat(wi, -1)
+
+
+def ba(poses, disps, intrinsics, disps_sens, targets, weights, eta, ii, jj, t0, t1, iterations, lm, ep, motion_only):
+    """ dense bundle adjustment, cpu version of ba_cuda (updates poses and disps in-place) """
+
+    ht, wd = disps.shape[1:]
+    P = t1 - t0
+
+    ts = torch.arange(t0, t1)
+    ii_exp = torch.cat([ts, ii], 0)
+    jj_exp = torch.cat([ts, jj], 0)
+    kx, kk_exp = torch.unique(ii_exp, return_inverse=True)
+    kk = kk_exp[P:]
+
+    dx = torch.zeros(P, 6)
+    dz = torch.zeros(kx.shape[0], ht*wd)
+
+    # motion only with no edge between two window poses, every pose is solved on its own
+    iv = (ii >= t0) & (ii < t1)
+    jv = (jj >= t0) & (jj < t1)
+    diagonal = motion_only and not torch.any(iv & jv & (ii != jj))
+
+    for itr in range(iterations):
+        Hs, vs, Eii, Eij, Cii, wi = \
+            _linearize(poses, disps, intrinsics, targets, weights, ii, jj)
+
+        b = torch.zeros(P, 6, dtype=torch.float64)
+        ix = torch.cat([ii, jj]) - t0
+        v = (ix >= 0) & (ix < P)
+        b.index_add_(0, ix[v], vs.reshape(-1, 6)[v].double())
+
+        if diagonal:
+            H = torch.zeros(P, 6, 6, dtype=torch.float64)
+            H.index_add_(0, ii[iv] - t0, Hs[0][iv].double())
+            H.index_add_(0, jj[jv] - t0, Hs[3][jv].double())
+
+            dx = block_diag_solve(H[None], b[None], ep, lm)[0].float()
+            poses[t0:t1] = lietorch.SE3(poses[t0:t1]).retr(dx).data
+            continue
+
+        # pose x pose block
+        rows, cols, vals = _block_triplets(Hs.reshape(-1, 6, 6),
+            torch.cat([ii, ii, jj, jj]) - t0, torch.cat([ii, jj, ii, jj]) - t0, P)
+
+        if not motion_only:
+            # add depth residual if there are depth sensor measurements
+            alpha = 0.05
+            m = (disps_sens[kx] > 0).float().view(-1, ht*wd)
+            C = torch.zeros(kx.shape[0], ht*wd).index_add_(0, kk, Cii) + m * alpha + (1 - m) * eta.view(-1, ht*wd)
+            w = torch.zeros(kx.shape[0], ht*wd).index_add_(0, kk, wi) - \
+                m * alpha * (disps[kx] - disps_sens[kx]).view(-1, ht*wd)
+            Q = 1.0 / C
+
+            # E rows: one per window pose (accumulated Eii) followed by one per edge (Eij)
+            Ei = torch.zeros(P, 6, ht*wd).index_add_(0, ii[iv] - t0, Eii[iv])
+            E = torch.cat([Ei, Eij], 0)
+            pp = jj_exp - t0
+
+            rv = (pp >= 0) & (pp < P)
+            E, pp, kr = E[rv], pp[rv], kk_exp[rv]
+
+            # schur complement over pairs of rows sharing a depth map
+            a, c = group_pairs(kr)
+            QE = E * Q[kr][:,None]
+
+            S = torch.zeros(a.shape[0], 6, 6)
+            for k in range(0, a.shape[0], SCHUR_CHUNK):
+                s = slice(k, k + SCHUR_CHUNK)
+                S[s] = torch.matmul(QE[a[s]], E[c[s]].transpose(1,2))
+
+            srows, scols, svals = _block_triplets(S, pp[a], pp[c], P)
+            rows = torch.cat([rows, srows])
+            cols = torch.cat([cols, scols])
+            vals = torch.cat([vals, -svals])
+
+            Ev = torch.einsum('nik,nk->ni', QE, w[kr])
+            b.index_add_(0, pp, -Ev.double())
+
+        dx = _sparse_solve(rows, cols, vals.double(), b.view(-1), 6*P, lm, ep)
+        dx = dx.view(P, 6).float()
+
+        if not motion_only:
+            dw = torch.einsum('nik,ni->nk', E, dx[pp])
+            dz = Q * (w - torch.zeros_like(w).index_add_(0, kr, dw))
+            disps[kx] += dz.view(-1, ht, wd)
+
+        poses[t0:t1] = lietorch.SE3(poses[t0:t1]).retr(dx).data
+
+    return [dx, dz]
+
+
+def frame_distance(poses, disps, intrinsics, ii, jj, beta):
+    """ mean optical flow between frames, cpu version of frame_distance_cuda """
+
+    ht, wd = disps.shape[1:]
+    fx, fy, cx, cy = intrinsics.tolist()
+
+    y, x = pops.pixel_grid(ht, wd, device=disps.device)
+
+    X0 = torch.stack([(x - cx) / fx, (y - cy) / fy, torch.ones_like(x)], dim=-1)
+
+    Gs = lietorch.SE3(poses)
+    dist = torch.zeros(ii.shape[0], device=disps.device)
+
+    for k in range(0, ii.shape[0], DISTANCE_CHUNK):
+        i, j = ii[k:k+DISTANCE_CHUNK], jj[k:k+DISTANCE_CHUNK]
+        Gij = Gs[j] * Gs[i].inv()
+
+        d = disps[i].unsqueeze(-1)
+        Xi = torch.cat([X0.expand(d.shape[0], ht, wd, 3), d], dim=-1)
+
+        # full rigid motion and translation only flow
+        X1 = (Gij[:,None,None] * Xi)[...,:3]
+        X2 = Xi[...,:3] + d * Gij.data[:,None,None,:3]
+
+        accum, valid = 0.0, 0.0
+        for Xj, b in [(X1, beta), (X2, 1 - beta)]:
+            du = fx * (Xj[...,0] / Xj[...,2]) + cx - x
+            dv = fy * (Xj[...,1] / Xj[...,2]) + cy - y
+
+            v = Xj[...,2] > MIN_DEPTH
+            flow = torch.where(v, torch.sqrt(du**2 + dv**2), torch.zeros_like(du))
+
+            accum = accum + b * flow.sum(dim=[1,2])
+            valid = valid + b * v.float().sum(dim=[1,2])
+
+        total = float(ht * wd)
+        dist[k:k+DISTANCE_CHUNK] = torch.where(valid / (total + 1e-8) < 0.75,
+            torch.full_like(valid, 1000.0), accum / valid)
+
+    return dist
+
+
+def depth_filter(poses, disps, intrinsics, ix, thresh):
+    """ number of neighboring keyframes consistent with each depth, cpu version of depth_filter_cuda """
+
+    num, ht, wd = disps.shape
+    fx, fy, cx, cy = intrinsics.tolist()
+
+    y, x = pops.pixel_grid(ht, wd, device=disps.device)
+    X0 = torch.stack([(x - cx) / fx, (y - cy) / fy, torch.ones_like(x)], dim=-1)
+
+    Gs = lietorch.SE3(poses)
+    counter = torch.zeros(ix.shape[0], ht, wd, device=disps.device)
+
+    # same neighbors as the kernel, three keyframes back and ix+3 .. ix+5
+    for offset in [-1, -2, -3, 3, 4, 5]:
+        k, = torch.where((ix + offset >= 0) & (ix + offset < num))
+        if k.shape[0] == 0:
+            continue
+
+        i, j = ix[k], ix[k] + offset
+        Gij = Gs[j] * Gs[i].inv()
+
+        d = disps[i].unsqueeze(-1)
+        Xj = Gij[:,None,None] * torch.cat([X0.expand(d.shape[0], ht, wd, 3), d], dim=-1)
+
+        uj = fx * (Xj[...,0] / Xj[...,2]) + cx
+        vj = fy * (Xj[...,1] / Xj[...,2]) + cy
+        dj = Xj[...,3] / Xj[...,2]
+
+        v = (uj >= 0) & (vj >= 0) & (uj < wd-1) & (vj < ht-1)
+        u0 = torch.where(v, uj, torch.zeros_like(uj)).floor().long()
+        v0 = torch.where(v, vj, torch.zeros_like(vj)).floor().long()
+
+        # consistent if any of the four neighboring depths agrees with the reprojected depth
+        dmap = disps[j].view(-1, ht*wd)
+        t = thresh[k][:,None,None]
+        agree = torch.zeros_like(v)
+        for o in [0, 1, wd, wd+1]:
+            dk = torch.gather(dmap, 1, (v0 * wd + u0 + o).view(-1, ht*wd)).view(-1, ht, wd)
+            agree |= torch.abs(1.0 / dj - 1.0 / dk) < t
+
+        counter[k] += (v & agree).float()
+
+    return counter
+
+
+def iproj(poses, disps, intrinsics):
+    """ point cloud of every pixel transformed by poses, cpu version of iproj_cuda """
+
+    ht, wd = disps.shape[1:]
+    fx, fy, cx, cy = intrinsics.tolist()
+
+    y, x = pops.pixel_grid(ht, wd, device=disps.device)
+    X0 = torch.stack([(x - cx) / fx, (y - cy) / fy, torch.ones_like(x)], dim=-1)
+
+    d = disps.unsqueeze(-1)
+    X = lietorch.SE3(poses)[:,None,None] * torch.cat([X0.expand(d.shape[0], ht, wd, 3), d], dim=-1)
+    return X[...,:3] / X[...,3:]
+
+
+def _window(x, y, r, ht, wd):
+    """ (2r+2)^2 integer window around floor(x, y), returns flat indices [P, x, y], in-bounds mask
+        and the fractional offsets """
+
+    # keep windows which are fully out of bounds out of bounds
+    x = x.clamp(-r-2, wd+r+1)
+    y = y.clamp(-r-2, ht+r+1)
+
+    x0, y0 = torch.floor(x), torch.floor(y)
+    o = torch.arange(-r, r+2, device=x.device)
+
+    X = (x0.long()[:,None] + o)[:,:,None].expand(-1, 2*r+2, 2*r+2)
+    Y = (y0.long()[:,None] + o)[:,None,:].expand(-1, 2*r+2, 2*r+2)
+
+    v = (X >= 0) & (X < wd) & (Y >= 0) & (Y < ht)
+    ix = Y.clamp(0, ht-1) * wd + X.clamp(0, wd-1)
+
+    return ix, v, x - x0, y - y0
+
+
+def _bilinear(s, dx, dy):
+    """ combine window values [P, x, y] into bilinear samples at the window offsets """
+    dx = dx[:,None,None]
+    dy = dy[:,None,None]
+
+    return s[:,:-1,:-1] * (1-dx) * (1-dy) + s[:,1:,:-1] * dx * (1-dy) + \
+        s[:,:-1,1:] * (1-dx) * dy + s[:,1:,1:] * dx * dy
+
+
+def corr_index_forward(volume, coords, radius):
+    """ sample correlation volume in a radius window, cpu version of corr_index_cuda_forward """
+
+    num, h1, w1, h2, w2 = volume.shape
+    rd = 2*radius + 1
+
+    volume = volume.reshape(num*h1*w1, h2*w2)
+    x = coords[:,0].reshape(-1).float()
+    y = coords[:,1].reshape(-1).float()
+
+    corr = []
+    for k in range(0, x.shape[0], CORR_CHUNK):
+        ix, v, dx, dy = _window(x[k:k+CORR_CHUNK], y[k:k+CORR_CHUNK], radius, h2, w2)
+        s = torch.gather(volume[k:k+CORR_CHUNK], 1, ix.reshape(ix.shape[0], -1)).view(ix.shape)
+        corr.append(_bilinear(s.float() * v, dx, dy))
+
+    corr = torch.cat(corr, 0).to(volume.dtype)
+    return [corr.view(num, h1, w1, rd, rd).permute(0,3,4,1,2).contiguous()]
+
+
+def altcorr_forward(fmap1, fmap2, coords, radius):
+    """ correlation in a radius window computed from features, cpu version of altcorr_cuda_forward """
+
+    B, S, ht, wd, _ = coords.shape
+    _, h2, w2, C = fmap2.shape
+    rd = 2*radius + 1
+
+    fmap1 = fmap1.reshape(B, 1, ht*wd, C).expand(B, S, ht*wd, C).reshape(-1, C)
+    fmap2 = fmap2.reshape(B, h2*w2, C)
+    b = torch.arange(B, device=coords.device)[:,None].expand(B, S*ht*wd).reshape(-1)
+
+    x = coords[...,0].reshape(-1).float()
+    y = coords[...,1].reshape(-1).float()
+
+    corr = []
+    for k in range(0, x.shape[0], ALTCORR_CHUNK):
+        ix, v, dx, dy = _window(x[k:k+ALTCORR_CHUNK], y[k:k+ALTCORR_CHUNK], radius, h2, w2)
+        f2 = fmap2[b[k:k+ALTCORR_CHUNK,None,None], ix].float()
+        s = torch.einsum('pc,pxyc->pxy', fmap1[k:k+ALTCORR_CHUNK].float(), f2)
+        corr.append(_bilinear(s * v, dx, dy))
+
+    corr = torch.cat(corr, 0).to(fmap1.dtype)
+    return [corr.view(B, S, ht, wd, rd*rd).permute(0,1,4,2,3).contiguous()]
@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+
+
+class Calibration:
+    """ pinhole camera with optional distortion, as in calib/*.txt: fx fy cx cy [k1 k2 p1 p2 [k3]].
+        undistortion (and rectification) maps are built once per input and output size, so each
+        frame is undistorted and resized by a single cv2.remap """
+
+    def __init__(self, intrinsics, distortion=None, rectify=None, projection=None):
+        self.intrinsics = np.asarray(intrinsics, dtype=np.float64)[:4]
+        self.distortion = None if distortion is None or not np.any(distortion) else \
+            np.asarray(distortion, dtype=np.float64)
+
+        # rectifying rotation and the 3x3 camera matrix of the rectified image
+        self.rectify = rectify
+        self.projection = projection
+        self.maps = {}
+
+    @classmethod
+    def from_file(cls, path):
+        calib = np.loadtxt(path, delimiter=" ")
+        return cls(calib[:4], calib[4:])
+
+    @property
+    def K(self):
+        fx, fy, cx, cy = self.intrinsics
+        return np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+
+    @property
+    def warped(self):
+        return self.distortion is not None or self.rectify is not None or self.projection is not None
+
+    def scaled(self, size0, size1):
+        """ intrinsics [fx, fy, cx, cy] of the remapped image, resized from size0 to size1 (ht, wd) """
+        K = self.K if self.projection is None else np.asarray(self.projection)[:3,:3]
+        fx, fy, cx, cy = K[0,0], K[1,1], K[0,2], K[1,2]
+        sx, sy = size1[1] / size0[1], size1[0] / size0[0]
+        return np.array([sx * fx, sy * fy, sx * cx, sy * cy])
+
+    def __maps(self, size0, size1):
+        key = tuple(size0) + tuple(size1)
+        if key not in self.maps:
+            fx, fy, cx, cy = self.scaled(size0, size1)
+            P = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+            self.maps[key] = cv2.initUndistortRectifyMap(self.K, self.distortion, self.rectify,
+                P, (size1[1], size1[0]), cv2.CV_32FC1)
+
+        return self.maps[key]
+
+    def remap(self, image, size=None):
+        """ undistort image and resize it to size (ht, wd) in the same pass """
+        size0 = image.shape[:2]
+        size1 = size0 if size is None else tuple(size)
+
+        if not self.warped:
+            return image if size1 == size0 else cv2.resize(image, (size1[1], size1[0]))
+
+        mapx, mapy = self.__maps(size0, size1)
+        return cv2.remap(image, mapx, mapy, interpolation=cv2.INTER_LINEAR)
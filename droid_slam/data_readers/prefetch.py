@@ -0,0 +1,43 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class Prefetcher:
+    """ iterate over load(item) for items, decoding up to `depth` items ahead of the consumer
+        in a pool of `workers` threads (or processes). results come out in the order of items,
+        no new item is started while `depth` results are waiting to be consumed """
+
+    def __init__(self, load, items, depth=8, workers=2, processes=False):
+        self.load = load
+        self.items = items
+        self.depth = depth
+        self.workers = workers
+        self.processes = processes
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        if self.depth <= 0 or self.workers <= 0:
+            for item in self.items:
+                yield self.load(item)
+            return
+
+        # processes need a picklable load function, threads suffice when it releases the gil
+        executor = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+
+        pending = collections.deque()
+        with executor(self.workers) as pool:
+            try:
+                for item in self.items:
+                    pending.append(pool.submit(self.load, item))
+                    if len(pending) >= self.depth:
+                        yield pending.popleft().result()
+
+                while len(pending) > 0:
+                    yield pending.popleft().result()
+
+            finally:
+                # consumer stopped early
+                for future in pending:
+                    future.cancel()
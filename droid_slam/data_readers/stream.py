@@ -14,6 +14,7 @@ import pickle
 import os.path as osp
 
 from .rgbd_utils import *
+from .calibration import Calibration
 
 class RGBDStream(data.Dataset):
     def __init__(self, datapath, frame_rate=-1, image_size=[384,512], crop_size=[0,0]):
@@ -73,7 +74,7 @@ class RGBDStream(data.Dataset):
 
 
 class ImageStream(data.Dataset):
-    def __init__(self, datapath, intrinsics, rate=1, image_size=[384,512]):
+    def __init__(self, datapath, intrinsics, rate=1, image_size=[384,512], calib=None):
         rgb_list = osp.join(datapath, 'rgb.txt')
         if os.path.isfile(rgb_list):
             rgb_list = np.loadtxt(rgb_list, delimiter=' ', dtype=np.unicode_)
@@ -90,16 +91,24 @@ class ImageStream(data.Dataset):
         self.intrinsics = intrinsics
         self.image_size = image_size
 
+        # undistortion maps, a Calibration or a path to a calib/*.txt file
+        if isinstance(calib, str):
+            calib = Calibration.from_file(calib)
+        self.calib = calib
+
     def __len__(self):
         return len(self.images)
 
     @staticmethod
-    def image_read(imfile):
-        return cv2.imread(imfile)
+    def image_read(imfile, calib=None):
+        image = cv2.imread(imfile)
+        if calib is not None:
+            image = calib.remap(image)
+        return image
 
     def __getitem__(self, index):
         """ return training video """
-        image = self.__class__.image_read(self.images[index])
+        image = self.__class__.image_read(self.images[index], self.calib)
 
         try:
             tstamp = self.timestamps[index]
@@ -152,8 +161,11 @@ class StereoStream(data.Dataset):
 
     @staticmethod
     def image_read(imfile, imap=None):
+        """ imap is a Calibration or a precomputed (mapx, mapy) pair """
         image = cv2.imread(imfile)
-        if imap is not None:
+        if isinstance(imap, Calibration):
+            image = imap.remap(image)
+        elif imap is not None:
             image = cv2.remap(image, imap[0], imap[1], interpolation=cv2.INTER_LINEAR)
         return image
 
@@ -1,49 +1,181 @@
 import numpy as np
 import torch
 import lietorch
-import droid_backends
+import cpu_backends
+
+try:
+    import droid_backends
+except ImportError:
+    droid_backends = None
 
 from torch.multiprocessing import Process, Queue, Lock, Value
 from collections import OrderedDict
 
 from droid_net import cvx_upsample
+from keyframe_store import KeyframeStore
 import geom.projective_ops as pops
 
+# state is reallocated with this factor when it runs out of frames
+GROWTH_FACTOR = 1.5
+
+class FrameDistanceCache:
+    """ memoized frame distances, entries are dropped when a frame's pose or disparity changes """
+
+    def __init__(self):
+        self.dist = None
+        self.poses = None
+        self.disps = None
+        self.key = None
+
+    def __invalidate(self, poses, disps, intrinsics, beta):
+        n = poses.shape[0]
+        key = (beta, tuple(intrinsics.tolist()), tuple(disps.shape[1:]))
+
+        if self.dist is None or key != self.key:
+            self.key = key
+            self.dist = torch.full((n, n), np.nan, device=poses.device)
+            self.poses = poses.clone()
+            self.disps = disps.clone()
+            return
+
+        # grow storage, new frames have no cached entries
+        m = self.dist.shape[0]
+        if n > m:
+            dist = torch.full((n, n), np.nan, device=poses.device)
+            dist[:m,:m] = self.dist
+            self.dist = dist
+            self.poses = torch.cat([self.poses, poses[m:]], 0)
+            self.disps = torch.cat([self.disps, disps[m:]], 0)
+
+        changed = (poses != self.poses[:n]).any(dim=1) | \
+            (disps != self.disps[:n]).flatten(1).any(dim=1)
+
+        if torch.any(changed):
+            ix = torch.where(changed)[0]
+            self.dist[ix] = np.nan
+            self.dist[:,ix] = np.nan
+            self.poses[ix] = poses[ix]
+            self.disps[ix] = disps[ix]
+
+    def __call__(self, kernel, poses, disps, intrinsics, ii, jj, beta):
+        """ distances for (ii, jj), only pairs not in the cache are passed to kernel """
+
+        self.__invalidate(poses, disps, intrinsics, beta)
+
+        d = self.dist[ii, jj]
+        miss = torch.isnan(d)
+
+        if torch.any(miss):
+            d[miss] = kernel(poses, disps, intrinsics, ii[miss], jj[miss], beta)
+            self.dist[ii[miss], jj[miss]] = d[miss]
+
+        return d
+
+
 class DepthVideo:
-    def __init__(self, image_size=[480, 640], buffer=1024, stereo=False, device="cuda:0"):
+    def __init__(self, image_size=[480, 640], buffer=1024, stereo=False, device="cuda:0", resident=-1, spill_dir=None):
                 
         # current keyframe count
         self.counter = Value('i', 0)
         self.ready = Value('i', 0)
         self.ht = ht = image_size[0]
         self.wd = wd = image_size[1]
+        self.device = device
 
         ### state attributes ###
-        self.tstamp = torch.zeros(buffer, device="cuda", dtype=torch.float).share_memory_()
-        self.images = torch.zeros(buffer, 3, ht, wd, device="cuda", dtype=torch.uint8)
-        self.dirty = torch.zeros(buffer, device="cuda", dtype=torch.bool).share_memory_()
-        self.red = torch.zeros(buffer, device="cuda", dtype=torch.bool).share_memory_()
-        self.poses = torch.zeros(buffer, 7, device="cuda", dtype=torch.float).share_memory_()
-        self.disps = torch.ones(buffer, ht//8, wd//8, device="cuda", dtype=torch.float).share_memory_()
-        self.disps_sens = torch.zeros(buffer, ht//8, wd//8, device="cuda", dtype=torch.float).share_memory_()
-        self.disps_up = torch.zeros(buffer, ht, wd, device="cuda", dtype=torch.float).share_memory_()
-        self.intrinsics = torch.zeros(buffer, 4, device="cuda", dtype=torch.float).share_memory_()
+        self.tstamp = torch.zeros(buffer, device=device, dtype=torch.float).share_memory_()
+        self.images = torch.zeros(buffer, 3, ht, wd, device=device, dtype=torch.uint8)
+        self.dirty = torch.zeros(buffer, device=device, dtype=torch.bool).share_memory_()
+        self.red = torch.zeros(buffer, device=device, dtype=torch.bool).share_memory_()
+        self.poses = torch.zeros(buffer, 7, device=device, dtype=torch.float).share_memory_()
+        self.disps = torch.ones(buffer, ht//8, wd//8, device=device, dtype=torch.float).share_memory_()
+        self.disps_sens = torch.zeros(buffer, ht//8, wd//8, device=device, dtype=torch.float).share_memory_()
+        self.disps_up = torch.zeros(buffer, ht, wd, device=device, dtype=torch.float).share_memory_()
+        self.intrinsics = torch.zeros(buffer, 4, device=device, dtype=torch.float).share_memory_()
+
+        # images and features are stored in physical slots, slots[i] holds keyframe i
+        self.slots = torch.arange(buffer, device=device, dtype=torch.long).share_memory_()
+
+        # bumped whenever a slot's features are written, cached correlations are keyed on it
+        self.versions = torch.zeros(buffer, device=device, dtype=torch.long).share_memory_()
 
         self.stereo = stereo
         c = 1 if not self.stereo else 2
 
         ### feature attributes ###
-        self.fmaps = torch.zeros(buffer, c, 128, ht//8, wd//8, dtype=torch.half, device="cuda").share_memory_()
-        self.nets = torch.zeros(buffer, 128, ht//8, wd//8, dtype=torch.half, device="cuda").share_memory_()
-        self.inps = torch.zeros(buffer, 128, ht//8, wd//8, dtype=torch.half, device="cuda").share_memory_()
+        # cpu convolutions have no half precision kernels
+        dtype = torch.half if torch.device(device).type == "cuda" else torch.float
+        # only `resident` keyframes are kept on the device, the rest are spilled to disk
+        self.fmaps = KeyframeStore(buffer, (c, 128, ht//8, wd//8), dtype, device, resident, spill_dir)
+        self.nets = KeyframeStore(buffer, (128, ht//8, wd//8), dtype, device, resident, spill_dir)
+        self.inps = KeyframeStore(buffer, (128, ht//8, wd//8), dtype, device, resident, spill_dir)
 
         # initialize poses to identity transformation
-        self.poses[:] = torch.as_tensor([0, 0, 0, 0, 0, 0, 1], dtype=torch.float, device="cuda")
+        self.poses[:] = torch.as_tensor([0, 0, 0, 0, 0, 0, 1], dtype=torch.float, device=device)
+
+        # frame distances of unchanged frames are reused across calls
+        self.distance_cache = FrameDistanceCache()
+
+        # reallocated state is passed on to processes attached with add_reader
+        self.readers = Value('i', 0)
+        self.generation = Value('i', 0)
+        self.local_generation = 0
+        self.resized = Queue()
         
     def get_lock(self):
         return self.counter.get_lock()
 
+    def add_reader(self):
+        """ register a process which reads the state, call before the process is started """
+        with self.get_lock():
+            self.readers.value += 1
+
+    def sync(self):
+        """ pick up state reallocated by the writer, called by reader processes """
+        while self.local_generation < self.generation.value:
+            self.__dict__.update(self.resized.get())
+            self.local_generation += 1
+
+    def __grow(self, n):
+        """ reallocate state with room for at least n frames """
+
+        m = self.tstamp.shape[0]
+        buffer = max(n, int(GROWTH_FACTOR * m))
+
+        state = {}
+        for name in ["tstamp", "images", "dirty", "red", "poses", "disps",
+                "disps_sens", "disps_up", "intrinsics", "slots", "versions"]:
+            x = getattr(self, name)
+            y = x.new_zeros((buffer,) + x.shape[1:])
+            y[:m] = x
+            state[name] = y.share_memory_()
+
+        state["poses"][m:] = torch.as_tensor([0, 0, 0, 0, 0, 0, 1], dtype=torch.float, device=self.device)
+        state["disps"][m:] = 1.0
+        state["slots"][m:] = torch.arange(m, buffer, device=self.device)
+        self.__dict__.update(state)
+
+        for store in [self.fmaps, self.nets, self.inps]:
+            store.grow(buffer)
+
+        for _ in range(self.readers.value):
+            self.resized.put(state)
+
+        self.generation.value += 1
+        self.local_generation += 1
+
     def __item_setter(self, index, item):
+        # keep room for the next frame, the frontend initializes it in place
+        if isinstance(index, int):
+            n = index + 2
+        elif isinstance(index, slice):
+            n = index.stop + 1
+        else:
+            n = int(torch.as_tensor(index).max()) + 2
+
+        if n > self.tstamp.shape[0]:
+            self.__grow(n)
+
         if isinstance(index, int) and index >= self.counter.value:
             self.counter.value = index + 1
         
@@ -51,8 +183,10 @@ class DepthVideo:
             self.counter.value = index.max().item() + 1
 
         # self.dirty[index] = True
+        slot = self.slots[index]
         self.tstamp[index] = item[0]
-        self.images[index] = item[1]
+        if item[1] is not None:
+            self.images[slot] = item[1]
 
         if item[2] is not None:
             self.poses[index] = item[2]
@@ -68,13 +202,14 @@ class DepthVideo:
             self.intrinsics[index] = item[5]
 
         if len(item) > 6:
-            self.fmaps[index] = item[6]
+            self.fmaps[slot] = item[6]
+            self.versions[slot] += 1
 
         if len(item) > 7:
-            self.nets[index] = item[7]
+            self.nets[slot] = item[7]
 
         if len(item) > 8:
-            self.inps[index] = item[8]
+            self.inps[slot] = item[8]
 
     def __setitem__(self, index, item):
         with self.get_lock():
@@ -88,13 +223,14 @@ class DepthVideo:
             if isinstance(index, int) and index < 0:
                 index = self.counter.value + index
 
+            slot = self.slots[index]
             item = (
                 self.poses[index],
                 self.disps[index],
                 self.intrinsics[index],
-                self.fmaps[index],
-                self.nets[index],
-                self.inps[index])
+                self.fmaps[slot],
+                self.nets[slot],
+                self.inps[slot])
 
         return item
 
@@ -102,11 +238,27 @@ class DepthVideo:
         with self.get_lock():
             self.__item_setter(self.counter.value, item)
 
+    def rm_keyframe(self, ix):
+        """ replace keyframe ix with keyframe ix+1 """
+
+        with self.get_lock():
+            self.poses[ix] = self.poses[ix+1]
+            self.disps[ix] = self.disps[ix+1]
+            self.disps_sens[ix] = self.disps_sens[ix+1]
+            self.intrinsics[ix] = self.intrinsics[ix+1]
+
+            # images and features are not copied, the freed slot is reused by ix+1
+            self.slots[[ix, ix+1]] = self.slots[[ix+1, ix]]
+
 
     ### geometric operations ###
 
+    def backends(self):
+        """ kernels matching the device of the video """
+        return droid_backends if self.poses.is_cuda else cpu_backends
+
     @staticmethod
-    def format_indicies(ii, jj):
+    def format_indicies(ii, jj, device="cuda"):
         """ to device, long, {-1} """
 
         if not isinstance(ii, torch.Tensor):
@@ -115,8 +267,8 @@ class DepthVideo:
         if not isinstance(jj, torch.Tensor):
             jj = torch.as_tensor(jj)
 
-        ii = ii.to(device="cuda", dtype=torch.long).reshape(-1)
-        jj = jj.to(device="cuda", dtype=torch.long).reshape(-1)
+        ii = ii.to(device=device, dtype=torch.long).reshape(-1)
+        jj = jj.to(device=device, dtype=torch.long).reshape(-1)
 
         return ii, jj
 
@@ -138,7 +290,7 @@ class DepthVideo:
 
     def reproject(self, ii, jj):
         """ project points from ii -> jj """
-        ii, jj = DepthVideo.format_indicies(ii, jj)
+        ii, jj = DepthVideo.format_indicies(ii, jj, self.device)
         Gs = lietorch.SE3(self.poses[None])
 
         coords, valid_mask = \
@@ -155,23 +307,18 @@ class DepthVideo:
             N = self.counter.value
             ii, jj = torch.meshgrid(torch.arange(N), torch.arange(N))
         
-        ii, jj = DepthVideo.format_indicies(ii, jj)
-
-        if bidirectional:
-
-            poses = self.poses[:self.counter.value].clone()
-
-            d1 = droid_backends.frame_distance(
-                poses, self.disps, self.intrinsics[0], ii, jj, beta)
+        ii, jj = DepthVideo.format_indicies(ii, jj, self.device)
 
-            d2 = droid_backends.frame_distance(
-                poses, self.disps, self.intrinsics[0], jj, ii, beta)
+        t = self.counter.value
+        poses = self.poses[:t].clone()
+        disps = self.disps[:t]
+        kernel = self.backends().frame_distance
 
-            d = .5 * (d1 + d2)
+        d = self.distance_cache(kernel, poses, disps, self.intrinsics[0], ii, jj, beta)
 
-        else:
-            d = droid_backends.frame_distance(
-                self.poses, self.disps, self.intrinsics[0], ii, jj, beta)
+        if bidirectional:
+            d2 = self.distance_cache(kernel, poses, disps, self.intrinsics[0], jj, ii, beta)
+            d = .5 * (d + d2)
 
         if return_matrix:
             return d.reshape(N, N)
@@ -182,12 +329,13 @@ class DepthVideo:
         """ dense bundle adjustment (DBA) """
 
         with self.get_lock():
+            ii, jj = DepthVideo.format_indicies(ii, jj, self.device)
 
             # [t0, t1] window of bundle adjustment optimization
             if t1 is None:
                 t1 = max(ii.max().item(), jj.max().item()) + 1
 
-            droid_backends.ba(self.poses, self.disps, self.intrinsics[0], self.disps_sens,
+            self.backends().ba(self.poses, self.disps, self.intrinsics[0], self.disps_sens,
                 target, weight, eta, ii, jj, t0, t1, itrs, lm, ep, motion_only)
 
             self.disps.clamp_(min=0.001)
@@ -4,10 +4,12 @@ import numpy as np
 
 from droid_net import DroidNet
 from depth_video import DepthVideo
+from keyframe_store import FrameStore
 from motion_filter import MotionFilter
 from droid_frontend import DroidFrontend
 from droid_backend import DroidBackend
 from trajectory_filler import PoseTrajectoryFiller
+from track_stats import TrackStats
 
 from collections import OrderedDict
 from torch.multiprocessing import Process
@@ -16,18 +18,31 @@ from torch.multiprocessing import Process
 class Droid:
     def __init__(self, args):
         super(Droid, self).__init__()
+        self.device = getattr(args, "device", "cuda:0")
         self.load_weights(args.weights)
         self.args = args
         self.disable_vis = args.disable_vis
 
+        # per-stage timings, memory and graph sizes, optionally logged per frame as jsonl
+        self.stats = TrackStats(getattr(args, "profile", False), getattr(args, "profile_log", None), self.device)
+
         # store images, depth, poses, intrinsics (shared between processes)
-        self.video = DepthVideo(args.image_size, args.buffer, stereo=args.stereo)
+        self.video = DepthVideo(args.image_size, args.buffer, stereo=args.stereo, device=self.device,
+            resident=getattr(args, "resident_keyframes", -1), spill_dir=getattr(args, "spill_dir", None))
+
+        # features of all frames for trajectory filling, on the host and optionally spilled to disk
+        self.frames = None
+        if getattr(args, "keep_features", False):
+            ht, wd = args.image_size
+            self.frames = FrameStore((1, 128, ht//8, wd//8), resident=getattr(args, "resident_frames", -1),
+                spill_dir=getattr(args, "spill_dir", None))
 
         # filter incoming frames so that there is enough motion
-        self.filterx = MotionFilter(self.net, self.video, thresh=args.filter_thresh)
+        self.filterx = MotionFilter(self.net, self.video, thresh=args.filter_thresh, device=self.device,
+            prefilter_thresh=getattr(args, "prefilter_thresh", 0.0), frames=self.frames)
 
         # frontend process
-        self.frontend = DroidFrontend(self.net, self.video, self.args)
+        self.frontend = DroidFrontend(self.net, self.video, self.args, stats=self.stats)
         
         # backend process
         self.backend = DroidBackend(self.net, self.video, self.args)
@@ -35,11 +50,13 @@ class Droid:
         # visualizer
         if not self.disable_vis:
             from visualization import droid_visualization
-            self.visualizer = Process(target=droid_visualization, args=(self.video,))
+            self.video.add_reader()
+            self.visualizer = Process(target=droid_visualization, args=(self.video, self.device))
             self.visualizer.start()
 
         # post processor - fill in poses for non-keyframes
-        self.traj_filler = PoseTrajectoryFiller(self.net, self.video)
+        self.traj_filler = PoseTrajectoryFiller(self.net, self.video, device=self.device, frames=self.frames,
+            chunk=getattr(args, "fill_chunk", -1))
 
 
     def load_weights(self, weights):
@@ -48,7 +65,7 @@ class Droid:
         print(weights)
         self.net = DroidNet()
         state_dict = OrderedDict([
-            (k.replace("module.", ""), v) for (k, v) in torch.load(weights).items()])
+            (k.replace("module.", ""), v) for (k, v) in torch.load(weights, map_location=self.device).items()])
 
         state_dict["update.weight.2.weight"] = state_dict["update.weight.2.weight"][:2]
         state_dict["update.weight.2.bias"] = state_dict["update.weight.2.bias"][:2]
@@ -56,18 +73,24 @@ class Droid:
         state_dict["update.delta.2.bias"] = state_dict["update.delta.2.bias"][:2]
 
         self.net.load_state_dict(state_dict)
-        self.net.to("cuda:0").eval()
+        self.net.to(self.device).eval()
 
     def track(self, tstamp, image, depth=None, intrinsics=None):
         """ main thread - update map """
 
         with torch.no_grad():
+            self.stats.begin(tstamp)
             num_keyframes = self.video.counter.value
             # check there is enough motion
-            self.filterx.track(tstamp, image, depth, intrinsics)
+            with self.stats.stage("filter"):
+                self.filterx.track(tstamp, image, depth, intrinsics)
 
             # local bundle adjustment
-            self.frontend()
+            with self.stats.stage("frontend"):
+                self.frontend()
+
+            self.__record_graph()
+            self.stats.end()
 
             count = self.video.counter.value
             keyframe_added = count > num_keyframes
@@ -79,11 +102,41 @@ class Droid:
             # # global bundle adjustment
             # self.backend(1)
 
+    def track_batch(self, tstamps, images, depths=None, intrinsics=None):
+        """ main thread - update map with a window of frames """
+
+        def frontend():
+            # keep the frontend out of the filter timings, as in track
+            with self.stats.suspend(), self.stats.stage("frontend"):
+                self.frontend()
+
+        with torch.no_grad():
+            self.stats.begin(tstamps[0], frames=len(tstamps))
+
+            # the frontend runs after every new keyframe, as in track
+            with self.stats.stage("filter"):
+                self.filterx.track_batch(tstamps, images, depths, intrinsics, callback=frontend)
+
+            self.__record_graph()
+            self.stats.end()
+
+    def __record_graph(self):
+        graph = self.frontend.graph
+        self.stats.graph(keyframes=self.video.counter.value, edges=graph.ii.shape[0],
+            inactive=graph.inactive.n, cached=len(graph.corr_cache))
+
     def get_full_est_traj(self, stream=None):
-        """get the full traj not only for Keyframes"""
-        camera_trajectory = self.traj_filler(stream)
+        """get the full traj not only for Keyframes, from the kept features if stream is None"""
+        with self.stats.stage("fill"):
+            camera_trajectory = self.traj_filler(stream)
         return camera_trajectory.inv().data.cpu().numpy()
 
+    def finish(self):
+        """ print the collected stats and close the stats log """
+        if self.stats.enabled:
+            print(self.stats)
+        self.stats.close()
+
     def terminate(self, stream=None):
         """ terminate the visualization process, return poses [t, q] """
 
@@ -91,12 +144,18 @@ class Droid:
 
         torch.cuda.empty_cache()
         print("#" * 32)
-        self.backend(7)
+        with self.stats.stage("backend"):
+            self.backend(7)
 
         torch.cuda.empty_cache()
         print("#" * 32)
-        self.backend(12)
+        with self.stats.stage("backend"):
+            self.backend(12)
+
+        with self.stats.stage("fill"):
+            camera_trajectory = self.traj_filler(stream)
+
+        self.finish()
 
-        camera_trajectory = self.traj_filler(stream)
         return camera_trajectory.inv().data.cpu().numpy()
 
@@ -29,7 +29,7 @@ class DroidBackend:
         if not self.video.stereo and not torch.any(self.video.disps_sens):
              self.video.normalize()
 
-        graph = FactorGraph(self.video, self.update_op, corr_impl="alt", max_factors=16*t, upsample=self.upsample)
+        graph = FactorGraph(self.video, self.update_op, device=self.video.device, corr_impl="alt", max_factors=16*t, upsample=self.upsample)
 
         graph.add_proximity_factors(rad=self.backend_radius, 
                                     nms=self.backend_nms, 
@@ -4,13 +4,19 @@ import numpy as np
 
 from lietorch import SE3
 from factor_graph import FactorGraph
+from track_stats import TrackStats
 
 
 class DroidFrontend:
-    def __init__(self, net, video, args):
+    def __init__(self, net, video, args, stats=None):
         self.video = video
+        self.stats = stats if stats is not None else TrackStats()
         self.update_op = net.update
-        self.graph = FactorGraph(video, net.update, max_factors=48, upsample=args.upsample)
+        self.graph = FactorGraph(video, net.update, device=video.device, max_factors=48, upsample=args.upsample,
+            corr_impl=getattr(args, "frontend_corr", "volume"),
+            inactive_budget=int(getattr(args, "inactive_budget", -1) * 2**20),
+            inactive_window=getattr(args, "inactive_window", -1),
+            corr_cache=int(getattr(args, "corr_cache", -1) * 2**20))
 
         # local optimization window
         self.t0 = 0
@@ -38,24 +44,28 @@ class DroidFrontend:
         self.count += 1
         self.t1 += 1
 
-        if self.graph.corr is not None:
-            self.graph.rm_factors(self.graph.age > self.max_age, store=True)
+        with self.stats.stage("edges"):
+            if self.graph.corr is not None:
+                self.graph.rm_factors(self.graph.age > self.max_age, store=True)
 
-        self.graph.add_proximity_factors(self.t1-5, max(self.t1-self.frontend_window, 0), 
-            rad=self.frontend_radius, nms=self.frontend_nms, thresh=self.frontend_thresh, beta=self.beta, remove=True)
+            self.graph.add_proximity_factors(self.t1-5, max(self.t1-self.frontend_window, 0), 
+                rad=self.frontend_radius, nms=self.frontend_nms, thresh=self.frontend_thresh, beta=self.beta, remove=True)
 
         self.video.disps[self.t1-1] = torch.where(self.video.disps_sens[self.t1-1] > 0, 
            self.video.disps_sens[self.t1-1], self.video.disps[self.t1-1])
 
         for itr in range(self.iters1):
-            self.graph.update(None, None, use_inactive=True)
+            with self.stats.stage("update"):
+                self.graph.update(None, None, use_inactive=True)
 
         # set initial pose for next frame
         poses = SE3(self.video.poses)
-        d = self.video.distance([self.t1-3], [self.t1-2], beta=self.beta, bidirectional=True)
+        with self.stats.stage("distance"):
+            d = self.video.distance([self.t1-3], [self.t1-2], beta=self.beta, bidirectional=True)
 
         if d.item() < self.keyframe_thresh:
-            self.graph.rm_keyframe(self.t1 - 2)
+            with self.stats.stage("rm_keyframe"):
+                self.graph.rm_keyframe(self.t1 - 2)
             
             with self.video.get_lock():
                 self.video.counter.value -= 1
@@ -63,7 +73,8 @@ class DroidFrontend:
 
         else:
             for itr in range(self.iters2):
-                self.graph.update(None, None, use_inactive=True)
+                with self.stats.stage("update"):
+                    self.graph.update(None, None, use_inactive=True)
 
         # set pose for next itration
         self.video.poses[self.t1] = self.video.poses[self.t1-1]
@@ -110,7 +121,8 @@ class DroidFrontend:
 
         # do initialization
         if not self.is_initialized and self.video.counter.value == self.warmup:
-            self.__initialize()
+            with self.stats.stage("initialize"):
+                self.__initialize()
             
         # do update
         elif self.is_initialized and self.t1 < self.video.counter.value:
@@ -4,12 +4,262 @@ import numpy as np
 
 import matplotlib.pyplot as plt
 from lietorch import SE3
+from collections import OrderedDict
 from modules.corr import CorrBlock, AltCorrBlock
 import geom.projective_ops as pops
 
+# edge (i, j) is indexed by the key i * EDGE_KEY_STRIDE + j
+EDGE_KEY_STRIDE = 2**32
+
+
+def _nms_offsets(ii, jj, nms):
+    """ offsets (di, dj) within the l1 suppression radius max(min(|i-j|-2, nms), 0) of each edge """
+
+    r = ((ii - jj).abs() - 2).clamp(max=nms).clamp(min=0)
+    for di in range(-nms, nms+1):
+        for dj in range(-nms, nms+1):
+            if abs(di) + abs(dj) <= nms:
+                yield r >= abs(di) + abs(dj), di, dj
+
+
+def _neighborhood_edges(t0, t, rad, stereo, device):
+    """ stereo and temporal neighbor edges, with a mask of the (i, j) entries to suppress """
+
+    i = torch.arange(t0, t, device=device)[:,None]
+    j = i - rad - 1 + torch.arange(rad+1, device=device)[None]
+    i = i.expand_as(j)
+
+    # per frame: (i, i), then (i, j), (j, i) for each neighbor j
+    es = torch.stack([i, j, j, i], -1).view(i.shape[0], -1, 2)
+    es = torch.cat([torch.stack([i[:,:1], i[:,:1]], -1), es], 1)
+
+    fwd = torch.zeros(es.shape[:2], dtype=torch.bool, device=device)
+    fwd[:,0] = True
+    fwd[:,1::2] = True
+
+    valid = torch.cat([torch.full_like(i[:,:1], stereo, dtype=torch.bool),
+        (j >= 0).repeat_interleave(2, dim=1)], 1)
+
+    return es[valid], fwd[valid]
+
+
+def _greedy_nms(ii, jj, t0, t1, t, nms, count):
+    """ greedy nms over candidates sorted by distance, returns the first count survivors """
+
+    N = ii.shape[0]
+    m = t - t1
+    rank = torch.arange(N, device=ii.device)
+    cell = (ii - t0) * m + (jj - t1)
+
+    def cover(ix):
+        """ minimum rank of the candidates ix covering each cell of the grid """
+        M = torch.full(((t - t0) * m,), N, dtype=torch.long, device=ii.device)
+        for v, di, dj in _nms_offsets(ii[ix], jj[ix], nms):
+            a = ix[v]
+            i1, j1 = ii[a] + di, jj[a] + dj
+            v = (t0 <= i1) & (i1 < t) & (t1 <= j1) & (j1 < t)
+            c = (i1[v] - t0) * m + (j1[v] - t1)
+            M[c] = torch.minimum(M[c], a[v])
+        return M
+
+    selected = torch.zeros(N, dtype=torch.bool, device=ii.device)
+    undecided = torch.ones(N, dtype=torch.bool, device=ii.device)
+
+    # each round selects all candidates not covered by an earlier undecided candidate
+    while count > 0 and torch.any(undecided):
+        ix = rank[undecided]
+        new = ix[cover(ix)[cell[ix]] == ix]
+        selected[new] = True
+        undecided[new] = False
+
+        # suppression only acts on later candidates
+        undecided &= ~(cover(new)[cell] < rank)
+
+        if torch.any(undecided) and \
+                selected[:rank[undecided].min()].sum() >= count:
+            break
+
+    return torch.where(selected)[0][:count]
+
+
+class EdgeStore:
+    """ preallocated per-edge tensors, live edges occupy rows [0, n) """
+
+    def __init__(self, growth=1.5):
+        self.n = 0
+        self.capacity = 0
+        self.growth = growth
+        self.fields = OrderedDict()
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __getitem__(self, name):
+        return self.fields[name][:self.n]
+
+    def __setitem__(self, name, value):
+        self.fields[name][:self.n] = value
+
+    def drop(self, name):
+        self.fields.pop(name, None)
+
+    def reserve(self, n):
+        """ grow storage geometrically so appends are amortized O(1) """
+        if n <= self.capacity:
+            return
+
+        capacity = max(n, int(self.growth * self.capacity))
+        for name, x in self.fields.items():
+            y = x.new_empty((capacity,) + x.shape[1:])
+            y[:self.n] = x[:self.n]
+            self.fields[name] = y
+
+        self.capacity = capacity
+
+    def append(self, **items):
+        k = next(iter(items.values())).shape[0]
+        self.reserve(self.n + k)
+
+        for name, x in items.items():
+            if name not in self.fields:
+                self.fields[name] = x.new_empty((self.capacity,) + x.shape[1:])
+            self.fields[name][self.n:self.n+k] = x
+
+        self.n += k
+
+    def remove(self, mask):
+        """ drop masked rows, holes are refilled with live rows from the tail """
+        k = int(mask.sum().item())
+        if k == 0:
+            return
+
+        n = self.n - k
+        holes = torch.where(mask[:n])[0]
+        fill = torch.where(~mask[n:self.n])[0] + n
+
+        for x in self.fields.values():
+            x[holes] = x[fill]
+
+        self.n = n
+
+
+class InactiveStore(EdgeStore):
+    """ inactive factors under a memory budget, indexed by their oldest keyframe """
+
+    def __init__(self, budget=-1, window=-1):
+        super(InactiveStore, self).__init__()
+        self.budget = budget
+        self.window = window
+        self.stamp = 0
+        self.lo, self.order = None, None
+
+    def append(self, **items):
+        k = items['ii'].shape[0]
+        items['stamp'] = torch.arange(self.stamp, self.stamp + k, device=items['ii'].device)
+        self.stamp += k
+
+        super(InactiveStore, self).append(**items)
+        self.order = None
+
+    def remove(self, mask):
+        super(InactiveStore, self).remove(mask)
+        self.order = None
+
+    def rm_keyframe(self, ix):
+        """ drop factors attached to keyframe ix, later keyframes shift down by one """
+        m = (self['ii'] == ix) | (self['jj'] == ix)
+        self['ii'][self['ii'] >= ix] -= 1
+        self['jj'][self['jj'] >= ix] -= 1
+        self.remove(m)
+
+    def evictable(self, t):
+        """ factors older than the keyframe window, then the oldest factors over budget """
+        ii, jj, stamp = self['ii'], self['jj'], self['stamp']
+        mask = torch.zeros_like(ii, dtype=torch.bool)
+
+        if self.window > 0:
+            mask |= torch.minimum(ii, jj) < t - self.window
+
+        if self.budget > 0 and self.n > 0:
+            row_bytes = sum(x[0].numel() * x.element_size() for x in self.fields.values())
+            excess = self.n - int(mask.sum().item()) - self.budget // row_bytes
+            if excess > 0:
+                oldest = torch.where(~mask)[0][torch.argsort(stamp[~mask])[:excess]]
+                mask[oldest] = True
+
+        return mask
+
+    def since(self, t):
+        """ rows of factors with both keyframes >= t """
+        if self.order is None:
+            self.lo, self.order = torch.sort(torch.minimum(self['ii'], self['jj']))
+
+        k = torch.searchsorted(self.lo, torch.as_tensor([t], device=self.lo.device))
+        return torch.sort(self.order[k[0]:])[0]
+
+
+class CorrCache:
+    """ correlation pyramids of edges that left the graph under a memory budget, least
+        recently used pyramids are dropped first. keyed by the video slots of both frames
+        and the versions of their features, so pyramids never outlive the features.
+        only edges removed from the edge index can be added again, so edges kept in the
+        inactive store are only cached once evicted by the inactive window or budget """
+
+    def __init__(self, budget=-1):
+        self.budget = budget
+        self.bytes = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, keys, levels):
+        """ store the pyramid of each edge, levels are [n, ...] tensors """
+        if self.budget <= 0:
+            return
+
+        for k, key in enumerate(keys):
+            pyramid = [lvl[k].clone() for lvl in levels]
+            if key in self.entries:
+                self.bytes -= self.__nbytes(self.entries.pop(key))
+
+            self.entries[key] = pyramid
+            self.bytes += self.__nbytes(pyramid)
+
+        while self.bytes > self.budget:
+            _, pyramid = self.entries.popitem(last=False)
+            self.bytes -= self.__nbytes(pyramid)
+
+    def take(self, keys):
+        """ remove and return cached pyramids, (hits, levels) with levels stacked over the hits """
+        hits = [k for k, key in enumerate(keys) if key in self.entries]
+        if len(hits) == 0:
+            return hits, None
+
+        pyramids = [self.entries.pop(keys[k]) for k in hits]
+        for pyramid in pyramids:
+            self.bytes -= self.__nbytes(pyramid)
+
+        return hits, [torch.stack(lvl, 0) for lvl in zip(*pyramids)]
+
+    def drop(self, keys):
+        """ forget the pyramids of edges that can not be added again """
+        for key in keys:
+            if key in self.entries:
+                self.bytes -= self.__nbytes(self.entries.pop(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    @staticmethod
+    def __nbytes(pyramid):
+        return sum(x.numel() * x.element_size() for x in pyramid)
+
 
 class FactorGraph:
-    def __init__(self, video, update_op, device="cuda:0", corr_impl="volume", max_factors=-1, upsample=False):
+    def __init__(self, video, update_op, device="cuda:0", corr_impl="volume", max_factors=-1, upsample=False,
+            inactive_budget=-1, inactive_window=-1, corr_cache=-1):
         self.video = video
         self.update_op = update_op
         self.device = device
@@ -22,35 +272,148 @@ class FactorGraph:
         self.wd = wd = video.wd // 8
 
         self.coords0 = pops.coords_grid(ht, wd, device=device)
-        self.ii = torch.as_tensor([], dtype=torch.long, device=device)
-        self.jj = torch.as_tensor([], dtype=torch.long, device=device)
-        self.age = torch.as_tensor([], dtype=torch.long, device=device)
-
-        self.corr, self.net, self.inp = None, None, None
         self.damping = 1e-6 * torch.ones_like(self.video.disps)
 
-        self.target = torch.zeros([1, 0, ht, wd, 2], device=device, dtype=torch.float)
-        self.weight = torch.zeros([1, 0, ht, wd, 2], device=device, dtype=torch.float)
+        # active factors (ii, jj, age, net, inp, target, weight, corr pyramid)
+        self.edges = EdgeStore()
+        self.edges.append(
+            ii=torch.as_tensor([], dtype=torch.long, device=device),
+            jj=torch.as_tensor([], dtype=torch.long, device=device),
+            age=torch.as_tensor([], dtype=torch.long, device=device),
+            target=torch.zeros([0, ht, wd, 2], device=device, dtype=torch.float),
+            weight=torch.zeros([0, ht, wd, 2], device=device, dtype=torch.float))
+
+        # inactive factors, bounded by inactive_budget bytes and an inactive_window of keyframes
+        self.inactive = InactiveStore(inactive_budget, inactive_window)
+        self.inactive.append(
+            ii=torch.as_tensor([], dtype=torch.long, device=device),
+            jj=torch.as_tensor([], dtype=torch.long, device=device),
+            target=torch.zeros([0, ht, wd, 2], device=device, dtype=torch.float),
+            weight=torch.zeros([0, ht, wd, 2], device=device, dtype=torch.float))
+
+        # correlation pyramids of retired edges, bounded by corr_cache bytes
+        self.corr_cache = CorrCache(corr_cache)
 
-        # inactive factors
-        self.ii_inac = torch.as_tensor([], dtype=torch.long, device=device)
-        self.jj_inac = torch.as_tensor([], dtype=torch.long, device=device)
         self.ii_bad = torch.as_tensor([], dtype=torch.long, device=device)
         self.jj_bad = torch.as_tensor([], dtype=torch.long, device=device)
 
-        self.target_inac = torch.zeros([1, 0, ht, wd, 2], device=device, dtype=torch.float)
-        self.weight_inac = torch.zeros([1, 0, ht, wd, 2], device=device, dtype=torch.float)
+        # sorted keys of all active and inactive edges
+        self.edge_keys = torch.as_tensor([], dtype=torch.long, device=device)
+
+    ### views into the edge stores ###
+
+    @property
+    def ii(self):
+        return self.edges['ii']
+
+    @property
+    def jj(self):
+        return self.edges['jj']
+
+    @property
+    def age(self):
+        return self.edges['age']
+
+    @age.setter
+    def age(self, value):
+        self.edges['age'] = value
+
+    @property
+    def net(self):
+        return self.edges['net'][None] if 'net' in self.edges else None
+
+    @net.setter
+    def net(self, value):
+        if value is None:
+            self.edges.drop('net')
+        else:
+            self.edges['net'] = value[0]
+
+    @property
+    def inp(self):
+        return self.edges['inp'][None] if 'inp' in self.edges else None
+
+    @inp.setter
+    def inp(self, value):
+        if value is None:
+            self.edges.drop('inp')
+        else:
+            self.edges['inp'] = value[0]
+
+    @property
+    def target(self):
+        return self.edges['target'][None]
+
+    @target.setter
+    def target(self, value):
+        self.edges['target'] = value[0]
+
+    @property
+    def weight(self):
+        return self.edges['weight'][None]
+
+    @weight.setter
+    def weight(self, value):
+        self.edges['weight'] = value[0]
+
+    @property
+    def corr(self):
+        if 'corr0' not in self.edges:
+            return None
+
+        levels = sum(1 for k in self.edges.fields if k.startswith('corr'))
+        return CorrBlock.from_pyramid([self.edges['corr%d' % i] for i in range(levels)],
+            lazy=self.corr_impl == "lazy")
+
+    @property
+    def ii_inac(self):
+        return self.inactive['ii']
+
+    @property
+    def jj_inac(self):
+        return self.inactive['jj']
+
+    @property
+    def target_inac(self):
+        return self.inactive['target'][None]
+
+    @property
+    def weight_inac(self):
+        return self.inactive['weight'][None]
+
+    def __index_edges(self, ii, jj):
+        """ insert edges into the edge index """
+        keys = ii * EDGE_KEY_STRIDE + jj
+        self.edge_keys, _ = torch.sort(torch.cat([self.edge_keys, keys]))
+
+    def __unindex_edges(self, ii, jj):
+        """ remove one occurrence of each edge from the edge index """
+        if ii.shape[0] == 0:
+            return
+
+        keys, counts = torch.unique(self.edge_keys, return_counts=True)
+        rkeys, rcounts = torch.unique(ii * EDGE_KEY_STRIDE + jj, return_counts=True)
+
+        ix = torch.searchsorted(keys, rkeys).clamp(max=keys.shape[0]-1)
+        found = keys[ix] == rkeys
+        counts[ix[found]] -= rcounts[found]
+
+        self.edge_keys = torch.repeat_interleave(keys, counts.clamp(min=0))
+
+    def __rebuild_edge_index(self):
+        """ rebuild the edge index after keyframe indices have changed """
+        self.edge_keys = torch.as_tensor([], dtype=torch.long, device=self.device)
+        self.__index_edges(torch.cat([self.ii, self.ii_inac]), torch.cat([self.jj, self.jj_inac]))
 
     def __filter_repeated_edges(self, ii, jj):
         """ remove duplicate edges """
 
-        keep = torch.zeros(ii.shape[0], dtype=torch.bool, device=ii.device)
-        eset = set(
-            [(i.item(), j.item()) for i, j in zip(self.ii, self.jj)] +
-            [(i.item(), j.item()) for i, j in zip(self.ii_inac, self.jj_inac)])
+        if self.edge_keys.shape[0] == 0:
+            return ii, jj
 
-        for k, (i, j) in enumerate(zip(ii, jj)):
-            keep[k] = (i.item(), j.item()) not in eset
+        keys = ii * EDGE_KEY_STRIDE + jj
+        ix = torch.searchsorted(self.edge_keys, keys).clamp(max=self.edge_keys.shape[0]-1)
+        keep = self.edge_keys[ix] != keys
 
         return ii[keep], jj[keep]
 
@@ -75,7 +438,7 @@ class FactorGraph:
 
         self.ii_bad = torch.cat([self.ii_bad, self.ii[mask]])
         self.jj_bad = torch.cat([self.jj_bad, self.jj[mask]])
-        self.rm_factors(mask, store=False)
+        self.rm_factors(mask, store=False, cache=False)
 
     def clear_edges(self):
         self.rm_factors(self.ii >= 0)
@@ -106,59 +469,107 @@ class FactorGraph:
             ix = torch.arange(len(self.age))[torch.argsort(self.age).cpu()]
             self.rm_factors(ix >= self.max_factors - ii.shape[0], store=True)
 
-        net = self.video.nets[ii].to(self.device).unsqueeze(0)
+        si = self.video.slots[ii]
+        sj = self.video.slots[jj]
 
-        # correlation volume for new edges
-        if self.corr_impl == "volume":
-            c = (ii == jj).long()
-            fmap1 = self.video.fmaps[ii,0].to(self.device).unsqueeze(0)
-            fmap2 = self.video.fmaps[jj,c].to(self.device).unsqueeze(0)
-            corr = CorrBlock(fmap1, fmap2)
-            self.corr = corr if self.corr is None else self.corr.cat(corr)
+        net = self.video.nets[si].to(self.device)
+        items = {}
 
-            inp = self.video.inps[ii].to(self.device).unsqueeze(0)
-            self.inp = inp if self.inp is None else torch.cat([self.inp, inp], 1)
+        # correlation volume for new edges
+        if self.corr_impl in ("volume", "lazy"):
+            hits, cached = self.corr_cache.take(self.__corr_keys(si, sj))
+            miss = torch.ones(len(ii), dtype=torch.bool, device=self.device)
+            miss[hits] = False
+
+            pyramid = []
+            if torch.any(miss):
+                c = (ii[miss] == jj[miss]).long()
+                fmap1 = self.video.fmaps[si[miss]][:,0].to(self.device).unsqueeze(0)
+                fmap2 = self.video.fmaps[sj[miss]][torch.arange(len(c)),c].to(self.device).unsqueeze(0)
+                pyramid = CorrBlock(fmap1, fmap2, lazy=self.corr_impl == "lazy").corr_pyramid
+
+            for i in range(max(len(pyramid), len(cached or []))):
+                if cached is None:
+                    items['corr%d' % i] = pyramid[i]
+                    continue
+
+                corr_lvl = cached[i].new_empty((len(ii),) + cached[i].shape[1:])
+                corr_lvl[~miss] = cached[i].to(self.device)
+                if len(pyramid) > 0:
+                    corr_lvl[miss] = pyramid[i]
+                items['corr%d' % i] = corr_lvl
+
+            items['inp'] = self.video.inps[si].to(self.device)
 
         with torch.cuda.amp.autocast(enabled=False):
             target, _ = self.video.reproject(ii, jj)
             weight = torch.zeros_like(target)
 
-        self.ii = torch.cat([self.ii, ii], 0)
-        self.jj = torch.cat([self.jj, jj], 0)
-        self.age = torch.cat([self.age, torch.zeros_like(ii)], 0)
-
         # reprojection factors
-        self.net = net if self.net is None else torch.cat([self.net, net], 1)
+        self.edges.append(ii=ii, jj=jj, age=torch.zeros_like(ii), 
+            net=net, target=target[0], weight=weight[0], **items)
 
-        self.target = torch.cat([self.target, target], 1)
-        self.weight = torch.cat([self.weight, weight], 1)
+        self.__index_edges(ii, jj)
 
     @torch.cuda.amp.autocast(enabled=True)
-    def rm_factors(self, mask, store=False):
+    def rm_factors(self, mask, store=False, cache=True):
         """ drop edges from factor graph """
 
+        mask = mask.to(self.device)
+        rows = torch.where(mask)[0]
+
         # store estimated factors
         if store:
-            self.ii_inac = torch.cat([self.ii_inac, self.ii[mask]], 0)
-            self.jj_inac = torch.cat([self.jj_inac, self.jj[mask]], 0)
-            self.target_inac = torch.cat([self.target_inac, self.target[:,mask]], 1)
-            self.weight_inac = torch.cat([self.weight_inac, self.weight[:,mask]], 1)
-
-        self.ii = self.ii[~mask]
-        self.jj = self.jj[~mask]
-        self.age = self.age[~mask]
-        
-        if self.corr_impl == "volume":
-            self.corr = self.corr[~mask]
-
-        if self.net is not None:
-            self.net = self.net[:,~mask]
+            stamp = self.inactive.stamp
+            self.inactive.append(ii=self.ii[mask], jj=self.jj[mask], 
+                target=self.edges['target'][mask], weight=self.edges['weight'][mask])
+
+            # edges still inactive stay indexed and suppressed, so only the evicted ones can return
+            evicted = self.__evict_inactive()
+            gone = torch.zeros(len(rows), dtype=torch.bool, device=self.device)
+            gone[evicted[evicted >= stamp] - stamp] = True
+
+        else:
+            self.__unindex_edges(self.ii[mask], self.jj[mask])
+            gone = torch.ones(len(rows), dtype=torch.bool, device=self.device)
+
+        # pyramids of edges that left the edge index may be picked up again by add_factors
+        if cache and 'corr0' in self.edges and self.corr_cache.budget > 0:
+            keys = self.__corr_keys(self.video.slots[self.ii[rows]], self.video.slots[self.jj[rows]])
+            self.corr_cache.drop([key for key, g in zip(keys, gone.tolist()) if not g])
+
+            if torch.any(gone):
+                self.corr_cache.put([key for key, g in zip(keys, gone.tolist()) if g],
+                    [self.edges[name][rows[gone]] for name in self.__corr_levels()])
+
+        self.edges.remove(mask)
+
+    def __corr_keys(self, si, sj):
+        """ cache keys of the correlation pyramids between slots si and sj """
+        keys = torch.stack([si, sj, self.video.versions[si], self.video.versions[sj]], -1)
+        return [tuple(key) for key in keys.tolist()]
+
+    def __corr_levels(self):
+        levels = sum(1 for k in self.edges.fields if k.startswith('corr'))
+        return ['corr%d' % i for i in range(levels)]
+
+    def __evict_inactive(self):
+        """ enforce the memory budget and keyframe window of the inactive store """
+        m = self.inactive.evictable(self.video.counter.value)
+        evicted = self.inactive['stamp'][m]
+        if torch.any(m):
+            self.__unindex_edges(self.ii_inac[m], self.jj_inac[m])
+            self.inactive.remove(m)
 
-        if self.inp is not None:
-            self.inp = self.inp[:,~mask]
+        return evicted
 
-        self.target = self.target[:,~mask]
-        self.weight = self.weight[:,~mask]
+    def __grow_damping(self):
+        """ follow the video when it has been reallocated with room for more keyframes """
+        m = self.damping.shape[0]
+        if m < self.video.disps.shape[0]:
+            damping = 1e-6 * torch.ones_like(self.video.disps)
+            damping[:m] = self.damping
+            self.damping = damping
 
 
     @torch.cuda.amp.autocast(enabled=True)
@@ -166,32 +577,15 @@ class FactorGraph:
         """ drop edges from factor graph """
 
 
-        with self.video.get_lock():
-            self.video.images[ix] = self.video.images[ix+1]
-            self.video.poses[ix] = self.video.poses[ix+1]
-            self.video.disps[ix] = self.video.disps[ix+1]
-            self.video.disps_sens[ix] = self.video.disps_sens[ix+1]
-            self.video.intrinsics[ix] = self.video.intrinsics[ix+1]
-
-            self.video.nets[ix] = self.video.nets[ix+1]
-            self.video.inps[ix] = self.video.inps[ix+1]
-            self.video.fmaps[ix] = self.video.fmaps[ix+1]
-
-        m = (self.ii_inac == ix) | (self.jj_inac == ix)
-        self.ii_inac[self.ii_inac >= ix] -= 1
-        self.jj_inac[self.jj_inac >= ix] -= 1
-
-        if torch.any(m):
-            self.ii_inac = self.ii_inac[~m]
-            self.jj_inac = self.jj_inac[~m]
-            self.target_inac = self.target_inac[:,~m]
-            self.weight_inac = self.weight_inac[:,~m]
+        self.video.rm_keyframe(ix)
+        self.inactive.rm_keyframe(ix)
 
         m = (self.ii == ix) | (self.jj == ix)
 
         self.ii[self.ii >= ix] -= 1
         self.jj[self.jj >= ix] -= 1
-        self.rm_factors(m, store=False)
+        self.rm_factors(m, store=False, cache=False)
+        self.__rebuild_edge_index()
 
 
     @torch.cuda.amp.autocast(enabled=True)
@@ -210,6 +604,8 @@ class FactorGraph:
         self.net, delta, weight, damping, upmask = \
             self.update_op(self.net, self.inp, corr, motn, self.ii, self.jj)
 
+        self.__grow_damping()
+
         if t0 is None:
             t0 = max(1, self.ii.min().item()+1)
 
@@ -221,7 +617,7 @@ class FactorGraph:
             self.damping[torch.unique(self.ii)] = damping
 
             if use_inactive:
-                m = (self.ii_inac >= t0 - 3) & (self.jj_inac >= t0 - 3)
+                m = self.inactive.since(t0 - 3)
                 ii = torch.cat([self.ii_inac[m], self.ii], 0)
                 jj = torch.cat([self.jj_inac[m], self.jj], 0)
                 target = torch.cat([self.target_inac[:,m], self.target], 1)
@@ -254,7 +650,8 @@ class FactorGraph:
         t = self.video.counter.value
 
         num, rig, ch, ht, wd = self.video.fmaps.shape
-        corr_op = AltCorrBlock(self.video.fmaps.view(1, num*rig, ch, ht, wd))
+        if not self.video.fmaps.spilled:
+            corr_op = AltCorrBlock(self.video.fmaps.data.view(1, num*rig, ch, ht, wd))
 
         for step in range(steps):
             print("Global BA Iteration #{}".format(step+1))
@@ -269,13 +666,26 @@ class FactorGraph:
                 iis = self.ii[v]
                 jjs = self.jj[v]
 
+                if not torch.any(v):
+                    continue
+
                 ht, wd = self.coords0.shape[0:2]
-                corr1 = corr_op(coords1[:,v], rig * iis, rig * jjs + (iis == jjs).long())
+                sis = self.video.slots[iis]
+                sjs = self.video.slots[jjs]
+                inp = self.video.inps[sis]
+
+                if self.video.fmaps.spilled:
+                    # page in features of this block only
+                    kk, kx = torch.unique(torch.cat([sis, sjs]), return_inverse=True)
+                    corr_op = AltCorrBlock(self.video.fmaps[kk].view(1, -1, ch, ht, wd))
+                    sis, sjs = kx[:len(sis)], kx[len(sis):]
+
+                corr1 = corr_op(coords1[:,v], rig * sis, rig * sjs + (iis == jjs).long())
 
                 with torch.cuda.amp.autocast(enabled=True):
                  
                     net, delta, weight, damping, upmask = \
-                        self.update_op(self.net[:,v], self.video.inps[None,iis], corr1, motn[:,v], iis, jjs)
+                        self.update_op(self.net[:,v], inp[None], corr1, motn[:,v], iis, jjs)
 
                     if self.upsample:
                         self.video.upsample(torch.unique(iis), upmask)
@@ -320,56 +730,38 @@ class FactorGraph:
         jj = jj.reshape(-1)
 
         d = self.video.distance(ii, jj, beta=beta)
+        ii, jj = ii.to(d.device), jj.to(d.device)
         d[ii - rad < jj] = np.inf
         d[d > 100] = np.inf
 
-        ii1 = torch.cat([self.ii, self.ii_bad, self.ii_inac], 0)
-        jj1 = torch.cat([self.jj, self.jj_bad, self.jj_inac], 0)
-        for i, j in zip(ii1.cpu().numpy(), jj1.cpu().numpy()):
-            for di in range(-nms, nms+1):
-                for dj in range(-nms, nms+1):
-                    if abs(di) + abs(dj) <= max(min(abs(i-j)-2, nms), 0):
-                        i1 = i + di
-                        j1 = j + dj
-
-                        if (t0 <= i1 < t) and (t1 <= j1 < t):
-                            d[(i1-t0)*(t-t1) + (j1-t1)] = np.inf
-
+        m = t - t1
 
-        es = []
-        for i in range(t0, t):
-            if self.video.stereo:
-                es.append((i, i))
-                d[(i-t0)*(t-t1) + (i-t1)] = np.inf
+        # suppress neighbors of existing edges
+        ii1 = torch.cat([self.ii, self.ii_bad, self.ii_inac], 0).to(d.device)
+        jj1 = torch.cat([self.jj, self.jj_bad, self.jj_inac], 0).to(d.device)
+        for v, di, dj in _nms_offsets(ii1, jj1, nms):
+            i1, j1 = ii1[v] + di, jj1[v] + dj
+            v = (t0 <= i1) & (i1 < t) & (t1 <= j1) & (j1 < t)
+            d[(i1[v]-t0)*m + (j1[v]-t1)] = np.inf
 
-            for j in range(max(i-rad-1,0), i):
-                es.append((i,j))
-                es.append((j,i))
-                d[(i-t0)*(t-t1) + (j-t1)] = np.inf
+        # stereo and temporal neighbors are always added
+        es, ex = _neighborhood_edges(t0, t, rad, self.video.stereo, d.device)
 
-        ix = torch.argsort(d)
-        for k in ix:
-            if d[k].item() > thresh:
-                continue
+        # flat index into d, negative values wrap around as with python indexing
+        ex = (es[ex,0] - t0) * m + (es[ex,1] - t1)
+        ex = torch.where(ex < 0, ex + d.shape[0], ex)
+        d[ex[ex >= 0]] = np.inf
 
-            if len(es) > self.max_factors:
-                break
-
-            i = ii[k]
-            j = jj[k]
-            
-            # bidirectional
-            es.append((i, j))
-            es.append((j, i))
+        # number of proximity edges admitted before len(es) exceeds max_factors
+        count = (self.max_factors - es.shape[0]) // 2 + 1 if es.shape[0] <= self.max_factors else 0
 
-            for di in range(-nms, nms+1):
-                for dj in range(-nms, nms+1):
-                    if abs(di) + abs(dj) <= max(min(abs(i-j)-2, nms), 0):
-                        i1 = i + di
-                        j1 = j + dj
+        kx = torch.where(d <= thresh)[0]
+        kx = kx[torch.sort(d[kx], stable=True)[1]]
+        kx = kx[_greedy_nms(ii[kx], jj[kx], t0, t1, t, nms, count)]
 
-                        if (t0 <= i1 < t) and (t1 <= j1 < t):
-                            d[(i1-t0)*(t-t1) + (j1-t1)] = np.inf
+        # bidirectional
+        i, j = ii[kx], jj[kx]
+        es = torch.cat([es, torch.stack([i, j, j, i], -1).view(-1, 2)], 0)
 
-        ii, jj = torch.as_tensor(es, device=self.device).unbind(dim=-1)
+        ii, jj = es.to(self.device).unbind(dim=-1)
         self.add_factors(ii, jj, remove)
@@ -2,7 +2,7 @@ import lietorch
 import torch
 import torch.nn.functional as F
 
-from .chol import block_solve, schur_solve
+from .chol import block_solve, block_diag_solve, sparse_schur_solve
 import geom.projective_ops as pops
 
 from torch_scatter import scatter_sum
@@ -28,43 +28,83 @@ def pose_retr(poses, dx, ii):
     return poses.retr(scatter_sum(dx, ii, dim=1, dim_size=poses.shape[1]))
 
 
-def BA(target, weight, eta, poses, disps, intrinsics, ii, jj, fixedp=1, rig=1):
-    """ Full Bundle Adjustment """
+# edge-pixels linearized at once, bounds the size of the jacobian tensors
+LINEARIZE_TILE = 2**20
+
+
+def linearize(target, weight, poses, disps, intrinsics, ii, jj, motion_only=False):
+    """ accumulate normal equation blocks over tiles of pixel rows, the jacobians
+        of one tile are materialized at a time """
 
     B, P, ht, wd = disps.shape
     N = ii.shape[0]
     D = poses.manifold_dim
 
-    ### 1: commpute jacobians and residuals ###
-    coords, valid, (Ji, Jj, Jz) = pops.projective_transform(
-        poses, disps, intrinsics, ii, jj, jacobian=True)
+    rows = max(1, min(ht, LINEARIZE_TILE // max(1, B * N * wd)))
+
+    Hii = Hij = Hji = Hjj = vi = vj = 0.0
+    Ei, Ej, Ck, wk = [], [], [], []
+
+    for r0 in range(0, ht, rows):
+        r1 = min(ht, r0 + rows)
+
+        # shift principal point so the tile is projected as a full image
+        shift = torch.as_tensor([0.0, 0.0, 0.0, r0], device=intrinsics.device)
+        coords, valid, (Ji, Jj, Jz) = pops.projective_transform(
+            poses, disps[:,:,r0:r1], intrinsics - shift, ii, jj, jacobian=True)
+
+        offset = torch.as_tensor([0.0, r0], device=coords.device)
+        r = (target[:,:,r0:r1] - offset - coords).view(B, N, -1, 1)
+        w = .001 * (valid * weight[:,:,r0:r1]).view(B, N, -1, 1)
+
+        Ji = Ji.reshape(B, N, -1, D)
+        Jj = Jj.reshape(B, N, -1, D)
+        wJiT = (w * Ji).transpose(2,3)
+        wJjT = (w * Jj).transpose(2,3)
 
-    r = (target - coords).view(B, N, -1, 1)
-    w = .001 * (valid * weight).view(B, N, -1, 1)
+        Hii = Hii + torch.matmul(wJiT, Ji)
+        Hij = Hij + torch.matmul(wJiT, Jj)
+        Hji = Hji + torch.matmul(wJjT, Ji)
+        Hjj = Hjj + torch.matmul(wJjT, Jj)
 
-    ### 2: construct linear system ###
-    Ji = Ji.reshape(B, N, -1, D)
-    Jj = Jj.reshape(B, N, -1, D)
-    wJiT = (w * Ji).transpose(2,3)
-    wJjT = (w * Jj).transpose(2,3)
+        vi = vi + torch.matmul(wJiT, r).squeeze(-1)
+        vj = vj + torch.matmul(wJjT, r).squeeze(-1)
 
-    Jz = Jz.reshape(B, N, ht*wd, -1)
+        if motion_only:
+            continue
 
-    Hii = torch.matmul(wJiT, Ji)
-    Hij = torch.matmul(wJiT, Jj)
-    Hji = torch.matmul(wJjT, Ji)
-    Hjj = torch.matmul(wJjT, Jj)
+        hw = (r1 - r0) * wd
+        Jz = Jz.reshape(B, N, hw, -1)
 
-    vi = torch.matmul(wJiT, r).squeeze(-1)
-    vj = torch.matmul(wJjT, r).squeeze(-1)
+        Ei.append((wJiT.view(B,N,D,hw,-1) * Jz[:,:,None]).sum(dim=-1))
+        Ej.append((wJjT.view(B,N,D,hw,-1) * Jz[:,:,None]).sum(dim=-1))
+
+        w = w.view(B, N, hw, -1)
+        r = r.view(B, N, hw, -1)
+        wk.append(torch.sum(w*r*Jz, dim=-1))
+        Ck.append(torch.sum(w*Jz*Jz, dim=-1))
+
+    if motion_only:
+        return Hii, Hij, Hji, Hjj, vi, vj
+
+    Ei = torch.cat(Ei, dim=-1)
+    Ej = torch.cat(Ej, dim=-1)
+    Ck = torch.cat(Ck, dim=-1)
+    wk = torch.cat(wk, dim=-1)
+
+    return Hii, Hij, Hji, Hjj, vi, vj, Ei, Ej, Ck, wk
+
+
+def BA(target, weight, eta, poses, disps, intrinsics, ii, jj, fixedp=1, rig=1):
+    """ Full Bundle Adjustment """
 
-    Ei = (wJiT.view(B,N,D,ht*wd,-1) * Jz[:,:,None]).sum(dim=-1)
-    Ej = (wJjT.view(B,N,D,ht*wd,-1) * Jz[:,:,None]).sum(dim=-1)
+    B, P, ht, wd = disps.shape
+    N = ii.shape[0]
+    D = poses.manifold_dim
 
-    w = w.view(B, N, ht*wd, -1)
-    r = r.view(B, N, ht*wd, -1)
-    wk = torch.sum(w*r*Jz, dim=-1)
-    Ck = torch.sum(w*Jz*Jz, dim=-1)
+    ### 1: commpute jacobians, residuals and linear system ###
+    Hii, Hij, Hji, Hjj, vi, vj, Ei, Ej, Ck, wk = \
+        linearize(target, weight, poses, disps, intrinsics, ii, jj)
 
     kx, kk = torch.unique(ii, return_inverse=True)
     M = kx.shape[0]
@@ -79,9 +119,6 @@ def BA(target, weight, eta, poses, disps, intrinsics, ii, jj, fixedp=1, rig=1):
         safe_scatter_add_mat(Hji, jj, ii, P, P) + \
         safe_scatter_add_mat(Hjj, jj, jj, P, P)
 
-    E = safe_scatter_add_mat(Ei, ii, kk, P, M) + \
-        safe_scatter_add_mat(Ej, jj, kk, P, M)
-
     v = safe_scatter_add_vec(vi, ii, P) + \
         safe_scatter_add_vec(vj, jj, P)
 
@@ -91,10 +128,15 @@ def BA(target, weight, eta, poses, disps, intrinsics, ii, jj, fixedp=1, rig=1):
     C = C + eta.view(*C.shape) + 1e-7
 
     H = H.view(B, P, P, D, D)
-    E = E.view(B, P, M, D, ht*wd)
+
+    # E blocks of all edges, blocks of fixed poses are dropped
+    E = torch.cat([Ei, Ej], dim=1)
+    pp = torch.cat([ii, jj])
+    ks = torch.cat([kk, kk]).to(pp.device)
+    m = (pp >= 0) & (pp < P)
 
     ### 3: solve the system ###
-    dx, dz = schur_solve(H, E, C, v, w)
+    dx, dz = sparse_schur_solve(H, E[:,m], pp[m], ks[m], C, v, w)
     
     ### 4: apply retraction ###
     poses = pose_retr(poses, dx, torch.arange(P) + fixedp)
@@ -113,40 +155,35 @@ def MoBA(target, weight, eta, poses, disps, intrinsics, ii, jj, fixedp=1, rig=1)
     N = ii.shape[0]
     D = poses.manifold_dim
 
-    ### 1: commpute jacobians and residuals ###
-    coords, valid, (Ji, Jj, Jz) = pops.projective_transform(
-        poses, disps, intrinsics, ii, jj, jacobian=True)
-
-    r = (target - coords).view(B, N, -1, 1)
-    w = .001 * (valid * weight).view(B, N, -1, 1)
-
-    ### 2: construct linear system ###
-    Ji = Ji.reshape(B, N, -1, D)
-    Jj = Jj.reshape(B, N, -1, D)
-    wJiT = (w * Ji).transpose(2,3)
-    wJjT = (w * Jj).transpose(2,3)
-
-    Hii = torch.matmul(wJiT, Ji)
-    Hij = torch.matmul(wJiT, Jj)
-    Hji = torch.matmul(wJjT, Ji)
-    Hjj = torch.matmul(wJjT, Jj)
-
-    vi = torch.matmul(wJiT, r).squeeze(-1)
-    vj = torch.matmul(wJjT, r).squeeze(-1)
+    ### 1: commpute jacobians, residuals and linear system ###
+    Hii, Hij, Hji, Hjj, vi, vj = linearize(target, weight, poses, disps, intrinsics, ii, jj, motion_only=True)
 
     # only optimize keyframe poses
     P = P // rig - fixedp
     ii = ii // rig - fixedp
     jj = jj // rig - fixedp
 
+    v = safe_scatter_add_vec(vi, ii, P) + \
+        safe_scatter_add_vec(vj, jj, P)
+
+    # no edge between two optimized poses, every pose is solved on its own
+    iv = (ii >= 0) & (ii < P)
+    jv = (jj >= 0) & (jj < P)
+    if not torch.any(iv & jv & (ii != jj)):
+        d = (ii == jj).to(Hij.device)
+        H = safe_scatter_add_vec(Hii, ii, P) + \
+            safe_scatter_add_vec(Hjj, jj, P) + \
+            safe_scatter_add_vec((Hij + Hji) * d[:,None,None], ii, P)
+
+        dx = block_diag_solve(H, v)
+        poses = pose_retr(poses, dx, torch.arange(P) + fixedp)
+        return poses
+
     H = safe_scatter_add_mat(Hii, ii, ii, P, P) + \
         safe_scatter_add_mat(Hij, ii, jj, P, P) + \
         safe_scatter_add_mat(Hji, jj, ii, P, P) + \
         safe_scatter_add_mat(Hjj, jj, jj, P, P)
 
-    v = safe_scatter_add_vec(vi, ii, P) + \
-        safe_scatter_add_vec(vj, jj, P)
-    
     H = H.view(B, P, P, D, D)
 
     ### 3: solve the system ###
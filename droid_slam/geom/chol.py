@@ -1,7 +1,16 @@
 import torch
 import torch.nn.functional as F
+import numpy as np
 import geom.projective_ops as pops
 
+import scipy.sparse
+import scipy.sparse.linalg
+
+from torch_scatter import scatter_sum
+
+# number of E-row pairs multiplied at once when forming the schur complement
+SCHUR_CHUNK = 1024
+
 class CholeskySolver(torch.autograd.Function):
     @staticmethod
     def forward(ctx, H, b):
@@ -29,6 +38,57 @@ class CholeskySolver(torch.autograd.Function):
 
         return dH, dz
 
+
+class SparseSolver(torch.autograd.Function):
+    """ solve block sparse systems with a sparse LU factorization on the host, A is
+        given as [B, K, D, D] blocks at block positions (ii, jj), b as [B, P, D] """
+
+    @staticmethod
+    def forward(ctx, A, ii, jj, b):
+        B, P, D = b.shape
+        d = torch.arange(D, device=ii.device)
+        rows = (D * ii[:,None,None] + d[None,:,None]).expand(-1, D, D).reshape(-1).cpu().numpy()
+        cols = (D * jj[:,None,None] + d[None,None,:]).expand(-1, D, D).reshape(-1).cpu().numpy()
+
+        vals = A.detach().double().cpu().numpy().reshape(B, -1)
+        rhs = b.detach().double().cpu().numpy().reshape(B, -1)
+
+        # don't crash training if the factorization fails
+        factors, xs = [], []
+        for k in range(B):
+            try:
+                lu = scipy.sparse.linalg.splu(scipy.sparse.coo_matrix((vals[k], (rows, cols)),
+                    shape=(P*D, P*D)).tocsc(), permc_spec="MMD_AT_PLUS_A")
+                x = lu.solve(rhs[k])
+                if not np.all(np.isfinite(x)):
+                    raise RuntimeError("non-finite solution")
+
+            except RuntimeError as e:
+                print(e)
+                lu, x = None, np.zeros(P*D)
+
+            factors.append(lu)
+            xs.append(x)
+
+        xs = torch.from_numpy(np.stack(xs)).to(b).view(B, P, D)
+        ctx.factors = factors
+        ctx.save_for_backward(ii, jj, xs)
+        return xs
+
+    @staticmethod
+    def backward(ctx, grad_x):
+        ii, jj, xs = ctx.saved_tensors
+        B, P, D = xs.shape
+
+        g = grad_x.detach().double().cpu().numpy().reshape(B, -1)
+        dz = [np.zeros(P*D) if lu is None else lu.solve(g[k], trans="T")
+            for k, lu in enumerate(ctx.factors)]
+
+        dz = torch.from_numpy(np.stack(dz)).to(grad_x).view(B, P, D)
+        dA = -dz[:,ii,:,None] * xs[:,jj,None,:]
+
+        return dA, None, None, dz
+
 def block_solve(H, b, ep=0.1, lm=0.0001):
     """ solve normal equations """
     B, N, _, D, _ = H.shape
@@ -43,6 +103,21 @@ def block_solve(H, b, ep=0.1, lm=0.0001):
     return x.reshape(B, N, D)
 
 
+def block_diag_solve(H, b, ep=0.1, lm=0.0001):
+    """ solve independent [D, D] systems with batched cholesky, H: [B, N, D, D], b: [B, N, D].
+        systems where the decomposition fails return zero """
+    D = H.shape[-1]
+    I = torch.eye(D, dtype=H.dtype, device=H.device)
+    H = H + (ep + lm*H) * I
+
+    L, info = torch.linalg.cholesky_ex(H)
+    ok = (info == 0)[...,None,None]
+    L = torch.where(ok, L, I)
+
+    x = torch.cholesky_solve(b.unsqueeze(-1), L)
+    return torch.where(ok, x, torch.zeros_like(x)).squeeze(-1)
+
+
 def schur_solve(H, E, C, v, w, ep=0.1, lm=0.0001, sless=False):
     """ solve using shur complement """
     
@@ -70,4 +145,67 @@ def schur_solve(H, E, C, v, w, ep=0.1, lm=0.0001, sless=False):
     dx = dx.reshape(B, P, D)
     dz = dz.reshape(B, M, HW)
 
-    return dx, dz
\ No newline at end of file
+    return dx, dz
+
+def group_pairs(kk):
+    """ all ordered pairs (a, b) of rows which share the same depth index """
+
+    kk_sorted, perm = torch.sort(kk)
+    counts = torch.bincount(kk_sorted)
+    start = torch.cumsum(counts, 0) - counts
+
+    n = counts[kk_sorted]
+    a = torch.repeat_interleave(torch.arange(kk.shape[0], device=kk.device), n)
+    offs = torch.arange(a.shape[0], device=kk.device) - torch.repeat_interleave(torch.cumsum(n, 0) - n, n)
+    b = start[kk_sorted[a]] + offs
+
+    return perm[a], perm[b]
+
+
+def sparse_schur_solve(H, E, pp, kk, C, v, w, ep=0.1, lm=0.0001, sless=False):
+    """ solve using shur complement, E is given as blocks E[:,r] at pose pp[r] and depth kk[r] """
+
+    B, P, _, D, _ = H.shape
+    _, M, HW = C.shape
+
+    # merge blocks at the same position
+    ux, ix = torch.unique(pp * M + kk, return_inverse=True)
+    E = scatter_sum(E, ix, dim=1, dim_size=ux.shape[0])
+    pp, kk = ux // M, ux % M
+
+    Q = 1.0 / C
+    QE = E * Q[:,kk,None]
+
+    # E Q E^T only has blocks between rows sharing a depth map
+    a, b = group_pairs(kk)
+    S = []
+    for i in range(0, a.shape[0], SCHUR_CHUNK):
+        s = slice(i, i + SCHUR_CHUNK)
+        S.append(torch.matmul(QE[:,a[s]], E[:,b[s]].transpose(-1,-2)))
+
+    S = torch.cat(S, dim=1).view(B, -1, D, D)
+
+    # nonzero blocks of H, all diagonal blocks are kept for the damping
+    nz = (H != 0).any(dim=4).any(dim=3).any(dim=0) | torch.eye(P, dtype=torch.bool, device=H.device)
+    hi, hj = torch.where(nz)
+    Hb = H[:,hi,hj]
+
+    # damping
+    I = torch.eye(D).to(H)
+    Hb = Hb + (hi == hj).to(H)[None,:,None,None] * (ep + lm*Hb) * I
+
+    # blocks of H - S, factored sparsely
+    ux, ix = torch.unique(torch.cat([hi * P + hj, pp[a] * P + pp[b]]), return_inverse=True)
+    A = scatter_sum(torch.cat([Hb, -S], dim=1), ix, dim=1, dim_size=ux.shape[0])
+
+    Ev = torch.einsum('brdk,brk->brd', QE, w[:,kk])
+    v = v - scatter_sum(Ev, pp, dim=1, dim_size=P)
+
+    dx = SparseSolver.apply(A, ux // P, ux % P, v.reshape(B, P, D))
+    if sless:
+        return dx
+
+    Ex = torch.einsum('brdk,brd->brk', E, dx[:,pp])
+    dz = Q * (w - scatter_sum(Ex, kk, dim=1, dim_size=M))
+
+    return dx, dz
@@ -23,12 +23,12 @@ def graph_to_edge_list(graph):
 def keyframe_indicies(graph):
     return torch.as_tensor([u for u in graph])
 
-def meshgrid(m, n, device='cuda'):
-    ii, jj = torch.meshgrid(torch.arange(m), torch.arange(n))
-    return ii.reshape(-1).to(device), jj.reshape(-1).to(device)
+def meshgrid(m, n, device=None):
+    ii, jj = torch.meshgrid(torch.arange(m, device=device), torch.arange(n, device=device))
+    return ii.reshape(-1), jj.reshape(-1)
 
-def neighbourhood_graph(n, r):
-    ii, jj = meshgrid(n, n)
+def neighbourhood_graph(n, r, device=None):
+    ii, jj = meshgrid(n, n, device=device)
     d = (ii - jj).abs()
     keep = (d >= 1) & (d <= r)
     return ii[keep], jj[keep]
@@ -8,21 +8,34 @@ MIN_DEPTH = 0.2
 def extract_intrinsics(intrinsics):
     return intrinsics[...,None,None,:].unbind(dim=-1)
 
-def coords_grid(ht, wd, **kwargs):
-    y, x = torch.meshgrid(
-        torch.arange(ht).to(**kwargs).float(),
-        torch.arange(wd).to(**kwargs).float())
+# pixel grids keyed by (name, ht, wd, device, dtype), shared by all callers
+GRID_CACHE = {}
 
-    return torch.stack([x, y], dim=-1)
+def pixel_grid(ht, wd, device=None, dtype=torch.float):
+    """ cached (y, x) pixel meshgrid, must not be modified in place """
+    key = ("pixel", ht, wd, torch.device(device or "cpu"), dtype)
+    if key not in GRID_CACHE:
+        GRID_CACHE[key] = torch.meshgrid(
+            torch.arange(ht, device=device, dtype=dtype),
+            torch.arange(wd, device=device, dtype=dtype))
+
+    return GRID_CACHE[key]
+
+def coords_grid(ht, wd, device=None):
+    """ cached (x, y) pixel coordinates, must not be modified in place """
+    key = ("coords", ht, wd, torch.device(device or "cpu"), torch.float)
+    if key not in GRID_CACHE:
+        y, x = pixel_grid(ht, wd, device=device)
+        GRID_CACHE[key] = torch.stack([x, y], dim=-1)
+
+    return GRID_CACHE[key]
 
 def iproj(disps, intrinsics, jacobian=False):
     """ pinhole camera inverse projection """
     ht, wd = disps.shape[2:]
     fx, fy, cx, cy = extract_intrinsics(intrinsics)
     
-    y, x = torch.meshgrid(
-        torch.arange(ht).to(disps.device).float(),
-        torch.arange(wd).to(disps.device).float())
+    y, x = pixel_grid(ht, wd, device=disps.device)
 
     i = torch.ones_like(disps)
     X = (x - cx) / fx
@@ -93,7 +106,7 @@ def actp(Gij, X0, jacobian=False):
 
     return X1, None
 
-def projective_transform(poses, depths, intrinsics, ii, jj, jacobian=False, return_depth=False):
+def projective_transform(poses, depths, intrinsics, ii, jj, jacobian=False, return_depth=False, min_depth=MIN_DEPTH):
     """ map points from ii->jj """
 
     # inverse project (pinhole)
@@ -102,14 +115,14 @@ def projective_transform(poses, depths, intrinsics, ii, jj, jacobian=False, retu
     # transform
     Gij = poses[:,jj] * poses[:,ii].inv()
 
-    Gij.data[:,ii==jj] = torch.as_tensor([-0.1, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0], device="cuda")
+    Gij.data[:,ii==jj] = torch.as_tensor([-0.1, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0], device=Gij.data.device)
     X1, Ja = actp(Gij, X0, jacobian=jacobian)
     
     # project (pinhole)
     x1, Jp = proj(X1, intrinsics[:,jj], jacobian=jacobian, return_depth=return_depth)
 
     # exclude points too close to camera
-    valid = ((X1[...,2] > MIN_DEPTH) & (X0[...,2] > MIN_DEPTH)).float()
+    valid = ((X1[...,2] > min_depth) & (X0[...,2] > min_depth)).float()
     valid = valid.unsqueeze(-1)
 
     if jacobian:
@@ -128,11 +141,7 @@ def induced_flow(poses, disps, intrinsics, ii, jj):
     """ optical flow induced by camera motion """
 
     ht, wd = disps.shape[2:]
-    y, x = torch.meshgrid(
-        torch.arange(ht).to(disps.device).float(),
-        torch.arange(wd).to(disps.device).float())
-
-    coords0 = torch.stack([x, y], dim=-1)
+    coords0 = coords_grid(ht, wd, device=disps.device)
     coords1, valid = projective_transform(poses, disps, intrinsics, ii, jj, False)
 
     return coords1[...,:2] - coords0, valid
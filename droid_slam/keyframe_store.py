@@ -0,0 +1,189 @@
+import tempfile
+import numpy as np
+import torch
+
+
+NUMPY_DTYPES = {
+    torch.half: np.float16,
+    torch.float: np.float32,
+}
+
+
+class KeyframeStore:
+    """ per-keyframe feature storage indexed by video slot. at most `resident` slots
+        are kept on the device, least recently used slots are spilled to a memory mapped file.
+        the storage is put in shared memory unless the store is `shared=False` (process local) """
+
+    def __init__(self, buffer, shape, dtype, device, resident=-1, spill_dir=None, shared=True):
+        self.shape = (buffer,) + tuple(shape)
+        self.spilled = resident > 0
+        self.shared = shared
+
+        if not self.spilled:
+            self.data = self.__share(torch.zeros(self.shape, dtype=dtype, device=device))
+            return
+
+        self.data = self.__share(torch.zeros((resident,) + self.shape[1:], dtype=dtype, device=device))
+
+        # unnamed file, removed when the store is released
+        self.spill_dir = spill_dir
+        self.file = tempfile.TemporaryFile(dir=spill_dir)
+        self.disk = np.memmap(self.file, dtype=NUMPY_DTYPES[dtype], mode="w+", shape=self.shape)
+
+        # slot -> resident row, resident row -> slot
+        self.row = torch.full((buffer,), -1, dtype=torch.long)
+        self.owner = torch.full((resident,), -1, dtype=torch.long)
+        self.ondisk = torch.zeros(buffer, dtype=torch.bool)
+
+        self.stamp = torch.zeros(resident, dtype=torch.long)
+        self.clock = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __share(self, x):
+        return x.share_memory_() if self.shared else x
+
+    def __getstate__(self):
+        # other processes only see the resident rows, the spill file stays with its owner
+        state = self.__dict__.copy()
+        state.pop("file", None)
+        state.pop("disk", None)
+        return state
+
+    def grow(self, buffer):
+        """ extend the number of slots to buffer """
+        m = self.shape[0]
+        self.shape = (buffer,) + self.shape[1:]
+
+        if not self.spilled:
+            data = self.data.new_zeros(self.shape)
+            data[:m] = self.data
+            self.data = self.__share(data)
+            return
+
+        file = tempfile.TemporaryFile(dir=self.spill_dir)
+        disk = np.memmap(file, dtype=self.disk.dtype, mode="w+", shape=self.shape)
+        disk[:m] = self.disk
+        self.file, self.disk = file, disk
+
+        self.row = torch.cat([self.row, self.row.new_full((buffer - m,), -1)])
+        self.ondisk = torch.cat([self.ondisk, self.ondisk.new_zeros(buffer - m)])
+
+    def __evict(self, rows):
+        """ write back resident rows which are not yet on disk """
+        slots = self.owner[rows]
+        v = slots >= 0
+
+        self.row[slots[v]] = -1
+        self.owner[rows] = -1
+
+        w = v & ~self.ondisk[slots.clamp(min=0)]
+        if torch.any(w):
+            self.disk[slots[w].numpy()] = self.data[rows[w].to(self.data.device)].cpu().numpy()
+            self.ondisk[slots[w]] = True
+
+    def __resident(self, slots):
+        """ resident rows for unique slots, missing slots take the least recently used rows """
+        rows = self.row[slots]
+        miss = rows < 0
+
+        n = int(miss.sum())
+        if n > 0:
+            stamp = self.stamp.clone()
+            stamp[rows[~miss]] = np.iinfo(np.int64).max
+            free = torch.argsort(stamp)[:n]
+
+            self.__evict(free)
+            self.row[slots[miss]] = free
+            self.owner[free] = slots[miss]
+            rows = self.row[slots]
+
+        self.clock += 1
+        self.stamp[rows] = self.clock
+        return rows, miss
+
+    def __read(self, slots):
+        """ read unique slots from disk """
+        x = torch.from_numpy(self.disk[slots.numpy()])
+        return x.to(device=self.data.device, dtype=self.data.dtype)
+
+    def __getitem__(self, slots):
+        """ features for slots, spilled slots are paged in """
+        if not self.spilled:
+            return self.data[slots]
+
+        slots = torch.as_tensor(slots)
+        shape = slots.shape
+        slots, inv = torch.unique(slots.cpu().reshape(-1), return_inverse=True)
+
+        if len(slots) > self.data.shape[0]:
+            # does not fit, read through without caching
+            out = self.__read(slots)
+            rows = self.row[slots]
+            v = rows >= 0
+            out[v.to(out.device)] = self.data[rows[v].to(out.device)]
+
+        else:
+            rows, miss = self.__resident(slots)
+            if torch.any(miss):
+                self.data[rows[miss].to(self.data.device)] = self.__read(slots[miss])
+            out = self.data[rows.to(self.data.device)]
+
+        return out[inv.to(out.device)].view(shape + self.shape[1:])
+
+    def __setitem__(self, slots, value):
+        value = torch.as_tensor(value).to(device=self.data.device, dtype=self.data.dtype)
+        if not self.spilled:
+            self.data[slots] = value
+            return
+
+        slots = torch.as_tensor(slots).cpu().reshape(-1)
+        value = value.expand((len(slots),) + self.shape[1:])
+
+        self.ondisk[slots] = False
+        if len(slots) > self.data.shape[0]:
+            self.disk[slots.numpy()] = value.cpu().numpy()
+            self.ondisk[slots] = True
+
+            rows = self.row[slots]
+            v = rows >= 0
+            self.owner[rows[v]] = -1
+            self.row[slots[v]] = -1
+
+        else:
+            rows, _ = self.__resident(slots)
+            self.data[rows.to(self.data.device)] = value
+
+
+class FrameStore:
+    """ fnet features, timestamps and intrinsics of every tracked frame, kept in half precision
+        so that trajectory filling does not have to decode and encode the video a second time.
+        only used by the tracking process, so the features stay out of shared memory by default """
+
+    def __init__(self, shape, device="cpu", resident=-1, spill_dir=None, buffer=1024, growth=1.5, shared=False):
+        self.n = 0
+        self.growth = growth
+        self.tstamps = []
+        self.intrinsics = []
+        self.fmaps = KeyframeStore(buffer, shape, torch.half, device, resident, spill_dir, shared)
+
+    def __len__(self):
+        return self.n
+
+    def append(self, tstamps, intrinsics, fmaps):
+        """ add frames, fmaps is [k, ...] """
+        k = len(tstamps)
+        if self.n + k > len(self.fmaps):
+            self.fmaps.grow(max(self.n + k, int(self.growth * len(self.fmaps))))
+
+        self.fmaps[torch.arange(self.n, self.n + k)] = fmaps
+        self.tstamps += [float(t) for t in tstamps]
+        self.intrinsics += [torch.as_tensor(x).cpu() for x in intrinsics]
+        self.n += k
+
+    def chunks(self, size):
+        """ (tstamps, intrinsics, fmaps) of consecutive frames in chunks of `size` """
+        for i in range(0, self.n, size):
+            j = min(i + size, self.n)
+            yield self.tstamps[i:j], self.intrinsics[i:j], self.fmaps[torch.arange(i, j)]
@@ -1,7 +1,12 @@
 import torch
 import torch.nn.functional as F
 
-import droid_backends
+import cpu_backends
+
+try:
+    import droid_backends
+except ImportError:
+    droid_backends = None
 
 class CorrSampler(torch.autograd.Function):
 
@@ -9,7 +14,8 @@ class CorrSampler(torch.autograd.Function):
     def forward(ctx, volume, coords, radius):
         ctx.save_for_backward(volume,coords)
         ctx.radius = radius
-        corr, = droid_backends.corr_index_forward(volume, coords, radius)
+        backends = droid_backends if volume.is_cuda else cpu_backends
+        corr, = backends.corr_index_forward(volume, coords, radius)
         return corr
 
     @staticmethod
@@ -21,11 +27,25 @@ class CorrSampler(torch.autograd.Function):
 
 
 class CorrBlock:
-    def __init__(self, fmap1, fmap2, num_levels=4, radius=3):
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=3, lazy=False):
         self.num_levels = num_levels
         self.radius = radius
+        self.lazy = lazy
         self.corr_pyramid = []
 
+        if lazy:
+            # keep fmap1 and pooled fmap2, correlation is computed around the sampled coords.
+            # pooling fmap2 gives the same levels as pooling the correlation volume
+            batch, num, dim, ht, wd = fmap1.shape
+            fmap1 = fmap1.reshape(batch*num, dim, ht, wd) / 4.0
+            fmap2 = fmap2.reshape(batch*num, dim, ht, wd) / 4.0
+
+            self.corr_pyramid.append(fmap1.permute(0,2,3,1).contiguous())
+            for i in range(self.num_levels):
+                self.corr_pyramid.append(fmap2.permute(0,2,3,1).contiguous())
+                fmap2 = F.avg_pool2d(fmap2, 2, stride=2)
+            return
+
         # all pairs correlation
         corr = CorrBlock.corr(fmap1, fmap2)
 
@@ -40,6 +60,18 @@ class CorrBlock:
     def __call__(self, coords):
         out_pyramid = []
         batch, num, ht, wd, _ = coords.shape
+
+        if self.lazy:
+            coords = coords.reshape(batch*num, 1, ht, wd, 2).float()
+            fmap1 = self.corr_pyramid[0].float()
+
+            for i in range(self.num_levels):
+                fmap2 = self.corr_pyramid[i+1].float()
+                corr = CorrLayer.apply(fmap1, fmap2, (coords / 2**i).contiguous(), self.radius)
+                out_pyramid.append(corr.view(batch, num, -1, ht, wd))
+
+            return torch.cat(out_pyramid, dim=2)
+
         coords = coords.permute(0,1,4,2,3)
         coords = coords.contiguous().view(batch*num, 2, ht, wd)
         
@@ -49,13 +81,23 @@ class CorrBlock:
 
         return torch.cat(out_pyramid, dim=2)
 
+    @classmethod
+    def from_pyramid(cls, corr_pyramid, radius=3, lazy=False):
+        """ wrap precomputed correlation levels (or features in lazy mode) """
+        block = cls.__new__(cls)
+        block.num_levels = len(corr_pyramid) - 1 if lazy else len(corr_pyramid)
+        block.radius = radius
+        block.lazy = lazy
+        block.corr_pyramid = list(corr_pyramid)
+        return block
+
     def cat(self, other):
-        for i in range(self.num_levels):
+        for i in range(len(self.corr_pyramid)):
             self.corr_pyramid[i] = torch.cat([self.corr_pyramid[i], other.corr_pyramid[i]], 0)
         return self
 
     def __getitem__(self, index):
-        for i in range(self.num_levels):
+        for i in range(len(self.corr_pyramid)):
             self.corr_pyramid[i] = self.corr_pyramid[i][index]
         return self
 
@@ -76,7 +118,8 @@ class CorrLayer(torch.autograd.Function):
     def forward(ctx, fmap1, fmap2, coords, r):
         ctx.r = r
         ctx.save_for_backward(fmap1, fmap2, coords)
-        corr, = droid_backends.altcorr_forward(fmap1, fmap2, coords, ctx.r)
+        backends = droid_backends if fmap1.is_cuda else cpu_backends
+        corr, = backends.altcorr_forward(fmap1, fmap2, coords, ctx.r)
         return corr
 
     @staticmethod
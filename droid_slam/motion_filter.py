@@ -1,6 +1,7 @@
 import cv2
 import torch
 import lietorch
+import torch.nn.functional as F
 
 from collections import OrderedDict
 from droid_net import DroidNet
@@ -8,11 +9,14 @@ from droid_net import DroidNet
 import geom.projective_ops as pops
 from modules.corr import CorrBlock
 
+# downsampling factor of the images compared by the pre-filter
+PREFILTER_SCALE = 8
+
 
 class MotionFilter:
     """ This class is used to filter incoming frames and extract features """
 
-    def __init__(self, net, video, thresh=2.5, device="cuda:0"):
+    def __init__(self, net, video, thresh=2.5, device="cuda:0", prefilter_thresh=0.0, frames=None):
         
         # split net modules
         self.cnet = net.cnet
@@ -23,6 +27,13 @@ class MotionFilter:
         self.thresh = thresh
         self.device = device
 
+        # frames closer than this to the last keyframe (mean abs intensity) skip the network
+        self.prefilter_thresh = prefilter_thresh
+        self.thumb = None
+
+        # optional FrameStore, keeps the features of every frame for trajectory filling
+        self.frames = frames
+
         self.count = 0
 
         # mean, std for image normalization
@@ -38,48 +49,115 @@ class MotionFilter:
     @torch.cuda.amp.autocast(enabled=True)
     def __feature_encoder(self, image):
         """ features for correlation volume """
-        return self.fnet(image).squeeze(0)
+        return self.fnet(image)
+
+    def __thumbnail(self, images):
+        """ downsampled grayscale images for the pre-filter """
+        gray = images[:,0].to(self.device).float().mean(dim=1, keepdim=True)
+        return F.avg_pool2d(gray, PREFILTER_SCALE, stride=PREFILTER_SCALE)[:,0]
+
+    def __prefilter(self, thumbs):
+        """ frames which differ enough from the last keyframe to be tested by the network """
+        if self.prefilter_thresh <= 0:
+            return torch.ones(len(thumbs), dtype=torch.bool, device=self.device)
+
+        return (thumbs - self.thumb).abs().mean(dim=[1,2]) > self.prefilter_thresh
+
+    @torch.cuda.amp.autocast(enabled=True)
+    def __motion(self, gmaps):
+        """ approximate flow magnitude to the last keyframe using 1 update iteration """
+
+        num, _, _, ht, wd = gmaps.shape
+
+        # index correlation volume
+        coords0 = pops.coords_grid(ht, wd, device=self.device)[None,None].expand(1, num, ht, wd, 2)
+        fmap1 = self.fmap[None,[0]].expand(1, num, -1, ht, wd)
+        corr = CorrBlock(fmap1, gmaps[None,:,0])(coords0)
+
+        net = self.net[None].expand(1, num, -1, ht, wd)
+        inp = self.inp[None].expand(1, num, -1, ht, wd)
+        _, delta, weight = self.update(net, inp, corr)
+
+        return delta.norm(dim=-1).mean(dim=[0,2,3])
 
     @torch.cuda.amp.autocast(enabled=True)
     @torch.no_grad()
     def track(self, tstamp, image, depth=None, intrinsics=None):
         """ main update operation - run on every frame in video """
+        self.track_batch([tstamp], [image], [depth], [intrinsics])
+
+    @torch.cuda.amp.autocast(enabled=True)
+    @torch.no_grad()
+    def track_batch(self, tstamps, images, depths=None, intrinsics=None, callback=None):
+        """ filter a window of frames, features of the frames passing the pre-filter are
+            extracted in one batch (of all frames, if they are kept for trajectory filling).
+            callback is run after each frame added to the video """
 
         Id = lietorch.SE3.Identity(1,).data.squeeze()
-        ht = image.shape[-2] // 8
-        wd = image.shape[-1] // 8
+        num = len(tstamps)
+
+        if depths is None:
+            depths = [None] * num
 
         # normalize images
-        inputs = image[None, :, [2,1,0]].to(self.device) / 255.0
+        inputs = torch.stack(images)[:, :, [2,1,0]].to(self.device) / 255.0
         inputs = inputs.sub_(self.MEAN).div_(self.STDV)
 
-        # extract features
-        gmap = self.__feature_encoder(inputs)
+        # thumbnails are only needed when the pre-filter is enabled
+        thumbs = [None] * num
+        if self.prefilter_thresh > 0:
+            thumbs = self.__thumbnail(torch.stack(images))
+
+        # features are extracted for frames which pass the pre-filter only
+        gmaps = [None] * num
+
+        def features(ix):
+            missing = [i for i in ix if gmaps[i] is None]
+            if len(missing) > 0:
+                for i, gmap in zip(missing, self.__feature_encoder(inputs[missing])):
+                    gmaps[i] = gmap
+            return torch.stack([gmaps[i] for i in ix])
+
+        if self.frames is not None:
+            fmaps = features(list(range(num)))
+            self.frames.append(tstamps, intrinsics, fmaps[:,:1])
+
+        k = 0
 
         ### always add first frame to the depth video ###
         if self.video.counter.value == 0:
-            net, inp = self.__context_encoder(inputs[:,[0]])
-            self.net, self.inp, self.fmap = net, inp, gmap
-            self.video.append(tstamp, image[0], Id, 1.0, depth, intrinsics / 8.0, gmap, net[0,0], inp[0,0])
+            gmap = features([0])[0]
+            net, inp = self.__context_encoder(inputs[[0]][:,[0]])
+            self.net, self.inp, self.fmap, self.thumb = net, inp, gmap, thumbs[0]
+            self.video.append(tstamps[0], images[0][0], Id, 1.0, depths[0], intrinsics[0] / 8.0, gmap, net[0,0], inp[0,0])
 
-        ### only add new frame if there is enough motion ###
-        else:                
-            # index correlation volume
-            coords0 = pops.coords_grid(ht, wd, device=self.device)[None,None]
-            corr = CorrBlock(self.fmap[None,[0]], gmap[None,[0]])(coords0)
+            k = 1
+            if callback is not None:
+                callback()
 
-            # approximate flow magnitude using 1 update iteration
-            _, delta, weight = self.update(self.net[None], self.inp[None], corr)
+        ### only add new frame if there is enough motion ###
+        while k < num:
+            # motion of all remaining frames relative to the last keyframe
+            candidates = k + torch.where(self.__prefilter(thumbs[k:]))[0].cpu()
+            if len(candidates) == 0:
+                self.count += num - k
+                break
+
+            accept, = torch.where(self.__motion(features(candidates.tolist())) > self.thresh)
+            if len(accept) == 0:
+                self.count += num - k
+                break
 
             # check motion magnitue / add new frame to video
-            if delta.norm(dim=-1).mean().item() > self.thresh:
-                self.count = 0
-                net, inp = self.__context_encoder(inputs[:,[0]])
-                self.net, self.inp, self.fmap = net, inp, gmap
-                self.video.append(tstamp, image[0], None, None, depth, intrinsics / 8.0, gmap, net[0], inp[0])
-
-            else:
-                self.count += 1
+            k = candidates[accept[0]].item()
+            self.count = 0
+            net, inp = self.__context_encoder(inputs[[k]][:,[0]])
+            self.net, self.inp, self.fmap, self.thumb = net, inp, gmaps[k], thumbs[k]
+            self.video.append(tstamps[k], images[k][0], None, None, depths[k], intrinsics[k] / 8.0, gmaps[k], net[0], inp[0])
+
+            k = k + 1
+            if callback is not None:
+                callback()
 
 
 
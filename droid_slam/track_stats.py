@@ -0,0 +1,159 @@
+import json
+import time
+import torch
+
+from collections import OrderedDict
+from contextlib import nullcontext
+
+
+class TrackStats:
+    """ per-stage wall time, call counts, peak device memory and graph sizes of the tracker.
+        stages nest, a stage opened inside another is recorded as parent/child, unless the
+        open stages are suspended. timings are only taken when enabled, since they
+        synchronize the device """
+
+    def __init__(self, enabled=False, log=None, device="cuda:0"):
+        self.enabled = enabled or log is not None
+        self.cuda = torch.device(device).type == "cuda"
+        self.device = device
+
+        self.log = open(log, "w") if log is not None else None
+
+        # totals over all frames, stage -> {calls, time, mem}
+        self.totals = OrderedDict()
+        self.frames = 0
+
+        # current frame, stage stack of [name, start, peak memory, time before suspension]
+        self.frame = None
+        self.stack = []
+        self.suspended = []
+
+    def __sync(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def __peak(self):
+        return torch.cuda.max_memory_allocated(self.device) if self.cuda else 0
+
+    def __reset_peak(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def begin(self, tstamp=None, frames=1):
+        """ start the record of a tracked frame, or of a batch of frames """
+        if not self.enabled:
+            return
+
+        tstamp = float(tstamp) if tstamp is not None else None
+        self.frame = OrderedDict(tstamp=tstamp, frames=frames, stages=OrderedDict(), graph=OrderedDict())
+
+    def end(self):
+        """ close the current record and emit it to the log """
+        if not self.enabled or self.frame is None:
+            return
+
+        self.frames += self.frame["frames"]
+        if self.log is not None:
+            self.log.write(json.dumps(self.frame) + "\n")
+            self.log.flush()
+
+        self.frame = None
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else nullcontext()
+
+    def suspend(self):
+        """ stop the clocks of the open stages, stages run meanwhile are recorded at the top level """
+        return _Suspend(self) if self.enabled else nullcontext()
+
+    def _suspend(self):
+        self.__sync()
+        now, peak = time.perf_counter(), self.__peak()
+        for s in self.stack:
+            s[2] = max(s[2], peak)
+            s[3] += now - s[1]
+
+        self.suspended.append(self.stack)
+        self.stack = []
+
+    def _resume(self):
+        self.__sync()
+        self.__reset_peak()
+        self.stack = self.suspended.pop()
+
+        now = time.perf_counter()
+        for s in self.stack:
+            s[1] = now
+
+    def _enter(self, name):
+        self.__sync()
+        if len(self.stack) > 0:
+            # keep the parent's peak before the counter is reset for the child
+            self.stack[-1][2] = max(self.stack[-1][2], self.__peak())
+            name = self.stack[-1][0] + "/" + name
+
+        self.__reset_peak()
+        self.stack.append([name, time.perf_counter(), 0, 0.0])
+
+    def _exit(self):
+        self.__sync()
+        name, start, peak, elapsed = self.stack.pop()
+        elapsed += time.perf_counter() - start
+        peak = max(peak, self.__peak())
+
+        if len(self.stack) > 0:
+            self.stack[-1][2] = max(self.stack[-1][2], peak)
+
+        for stats in [self.totals] + ([self.frame["stages"]] if self.frame is not None else []):
+            s = stats.setdefault(name, OrderedDict(calls=0, time=0.0, mem=0))
+            s["calls"] += 1
+            s["time"] += elapsed
+            s["mem"] = max(s["mem"], peak)
+
+    def graph(self, **counts):
+        """ record edge and keyframe counts of the current frame """
+        if self.enabled and self.frame is not None:
+            self.frame["graph"].update(counts)
+
+    def summary(self):
+        """ totals per stage with the mean time per call """
+        out = OrderedDict()
+        for name, s in self.totals.items():
+            out[name] = OrderedDict(s, mean=s["time"] / s["calls"])
+
+        return out
+
+    def __str__(self):
+        lines = ["%-40s %8s %10s %10s %10s" % ("stage", "calls", "total (s)", "mean (ms)", "mem (MB)")]
+        for name, s in self.summary().items():
+            lines.append("%-40s %8d %10.3f %10.3f %10.1f" % (name, s["calls"], s["time"], 1000 * s["mean"], s["mem"] / 2**20))
+
+        return "\n".join(lines)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class _Stage:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats._enter(self.name)
+
+    def __exit__(self, *args):
+        self.stats._exit()
+
+
+class _Suspend:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.stats._suspend()
+
+    def __exit__(self, *args):
+        self.stats._resume()
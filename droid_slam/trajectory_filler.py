@@ -8,11 +8,45 @@ from factor_graph import FactorGraph
 from droid_net import DroidNet
 import geom.projective_ops as pops
 
+# frames filled together, chunks grow up to FILL_MAX_CHUNK frames when device memory allows
+FILL_CHUNK = 16
+FILL_MAX_CHUNK = 256
+
+# share of free device memory one chunk may use
+FILL_MEMORY = 0.5
+
+
+def bracket_keyframes(ts, tq):
+    """ indices (t0, t1) of the keyframes at sorted times ts around each query time tq,
+        queries before the first or after the last keyframe have t0 == t1 """
+    t0 = (torch.searchsorted(ts, tq, right=True) - 1).clamp(min=0)
+    t1 = torch.where((t0 < ts.shape[0] - 1) & (tq >= ts[0]), t0 + 1, t0)
+    return t0, t1
+
+
+def interpolate_poses(ts, poses, tq, t0=None, t1=None):
+    """ poses at query times tq, linearly interpolated on SE3 between the poses at sorted
+        times ts. queries outside of ts take the first or last pose """
+
+    if not isinstance(poses, SE3):
+        poses = SE3(poses)
+
+    tq = torch.as_tensor(tq, dtype=ts.dtype, device=ts.device)
+    if t0 is None or t1 is None:
+        t0, t1 = bracket_keyframes(ts, tq)
+
+    dt = ts[t1] - ts[t0] + 1e-3
+    dP = poses[t1] * poses[t0].inv()
+
+    v = dP.log() / dt.unsqueeze(-1)
+    w = v * (tq - ts[t0]).unsqueeze(-1)
+    return SE3.exp(w) * poses[t0]
+
 
 class PoseTrajectoryFiller:
     """ This class is used to fill in non-keyframe poses """
 
-    def __init__(self, net, video, device="cuda:0"):
+    def __init__(self, net, video, device="cuda:0", frames=None, chunk=-1):
         
         # split net modules
         self.cnet = net.cnet
@@ -23,6 +57,15 @@ class PoseTrajectoryFiller:
         self.video = video
         self.device = device
 
+        # features kept by the motion filter, used when no image stream is given
+        self.frames = frames
+
+        # fixed chunk size, or sized to free device memory if chunk <= 0
+        self.chunk = chunk
+
+        # factor graph reused by all chunks
+        self.graph = None
+
         # mean, std for image normalization
         self.MEAN = torch.as_tensor([0.485, 0.456, 0.406], device=self.device)[:, None, None]
         self.STDV = torch.as_tensor([0.229, 0.224, 0.225], device=self.device)[:, None, None]
@@ -32,41 +75,40 @@ class PoseTrajectoryFiller:
         """ features for correlation volume """
         return self.fnet(image)
 
-    def __fill(self, tstamps, images, intrinsics):
+    def __fill(self, tstamps, intrinsics, fmap, images=None):
         """ fill operator """
 
-        tt = torch.as_tensor(tstamps, device="cuda")
-        images = torch.stack(images, 0)
-        intrinsics = torch.stack(intrinsics, 0)
-        inputs = images[:,:,[2,1,0]].to(self.device) / 255.0
+        # frames are filled in the free slots past the counter, chunks which do not fit
+        # are split so that filling never grows the video
+        room = self.video.tstamp.shape[0] - self.video.counter.value - 1
+        if len(tstamps) > room > 0:
+            head = self.__fill(tstamps[:room], intrinsics[:room], fmap[:room],
+                None if images is None else images[:room])
+            return head + self.__fill(tstamps[room:], intrinsics[room:], fmap[room:],
+                None if images is None else images[room:])
+
+        tt = torch.as_tensor(tstamps, device=self.device)
+        intrinsics = torch.stack(intrinsics, 0).to(self.device)
         
         ### linear pose interpolation ###
         N = self.video.counter.value
         M = len(tstamps)
 
         ts = self.video.tstamp[:N]
-        Ps = SE3(self.video.poses[:N])
-
-        t0 = torch.as_tensor([ts[ts<=t].shape[0] - 1 for t in tstamps])
-        t1 = torch.where(t0<N-1, t0+1, t0)
+        tt = tt.to(ts.dtype)
 
-        dt = ts[t1] - ts[t0] + 1e-3
-        dP = Ps[t1] * Ps[t0].inv()
-
-        v = dP.log() / dt.unsqueeze(-1)
-        w = v * (tt - ts[t0]).unsqueeze(-1)
-        Gs = SE3.exp(w) * Ps[t0]
-
-        # extract features (no need for context features)
-        inputs = inputs.sub_(self.MEAN).div_(self.STDV)
-        fmap = self.__feature_encoder(inputs)
+        t0, t1 = bracket_keyframes(ts, tt)
+        Gs = interpolate_poses(ts, self.video.poses[:N], tt, t0, t1)
 
         self.video.counter.value += M
-        self.video[N:N+M] = (tt, images[:,0], Gs.data, 1, None, intrinsics / 8.0, fmap)
+        self.video[N:N+M] = (tt, images, Gs.data, 1, None, intrinsics / 8.0, fmap.to(self.device))
 
-        graph = FactorGraph(self.video, self.update)
-        graph.add_factors(t0.cuda(), torch.arange(N, N+M).cuda())
-        graph.add_factors(t1.cuda(), torch.arange(N, N+M).cuda())
+        if self.graph is None:
+            self.graph = FactorGraph(self.video, self.update, device=self.device)
+
+        graph = self.graph
+        graph.add_factors(t0.to(self.device), torch.arange(N, N+M, device=self.device))
+        graph.add_factors(t1.to(self.device), torch.arange(N, N+M, device=self.device))
 
         for itr in range(6):
             graph.update(N, N+M, motion_only=True)
@@ -74,14 +116,69 @@ class PoseTrajectoryFiller:
         Gs = SE3(self.video.poses[N:N+M].clone())
         self.video.counter.value -= M
 
+        # edge storage is kept for the next chunk
+        graph.rm_factors(graph.ii >= 0)
+
         return [ Gs ]
 
+    def __fill_images(self, tstamps, images, intrinsics):
+        """ fill operator for decoded images """
+
+        images = torch.stack(images, 0)
+        inputs = images[:,:,[2,1,0]].to(self.device) / 255.0
+
+        # extract features (no need for context features)
+        inputs = inputs.sub_(self.MEAN).div_(self.STDV)
+        fmap = self.__feature_encoder(inputs)
+
+        return self.__fill(tstamps, intrinsics, fmap, images[:,0])
+
+    def interpolate(self, tstamps):
+        """ initial poses at arbitrary times, interpolated between the keyframe poses """
+        with self.video.get_lock():
+            N = self.video.counter.value
+            ts = self.video.tstamp[:N].clone()
+            poses = self.video.poses[:N].clone()
+
+        return interpolate_poses(ts, poses, torch.as_tensor(tstamps, device=ts.device))
+
+    def __chunk_size(self):
+        """ frames per chunk. filled frames only depend on keyframes, so chunks which fit in
+            memory side by side are solved together, as one batched motion only update """
+        if self.chunk > 0:
+            return self.chunk
+
+        if torch.device(self.device).type != "cuda":
+            return FILL_CHUNK
+
+        free, _ = torch.cuda.mem_get_info(self.device)
+        ht, wd = self.video.ht // 8, self.video.wd // 8
+
+        # two edges per frame with 4 level half precision correlation pyramids,
+        # and the video slot the frame occupies
+        corr = 2 * 2 * (ht * wd)**2 * 4 // 3
+        slot = 3 * self.video.ht * self.video.wd + 2 * 3 * 128 * ht * wd
+
+        n = int(FILL_MEMORY * free) // (corr + slot)
+        return max(FILL_CHUNK, min(n, FILL_MAX_CHUNK))
+
     @torch.no_grad()
-    def __call__(self, image_stream):
-        """ fill in poses of non-keyframe images """
+    def __call__(self, image_stream=None):
+        """ fill in poses of non-keyframe images, from the features kept during
+            tracking when no image stream is given """
 
         # store all camera poses
         pose_list = []
+        chunk = self.__chunk_size()
+
+        if image_stream is None:
+            if self.frames is None:
+                raise ValueError("filling the trajectory without an image stream requires --keep_features")
+
+            for (tstamps, intrinsics, fmap) in self.frames.chunks(chunk):
+                pose_list += self.__fill(tstamps, intrinsics, fmap)
+
+            return lietorch.cat(pose_list, 0)
 
         tstamps = []
         images = []
@@ -92,12 +189,12 @@ class PoseTrajectoryFiller:
             images.append(image)
             intrinsics.append(intrinsic)
 
-            if len(tstamps) == 16:
-                pose_list += self.__fill(tstamps, images, intrinsics)
+            if len(tstamps) == chunk:
+                pose_list += self.__fill_images(tstamps, images, intrinsics)
                 tstamps, images, intrinsics = [], [], []
 
         if len(tstamps) > 0:
-            pose_list += self.__fill(tstamps, images, intrinsics)
+            pose_list += self.__fill_images(tstamps, images, intrinsics)
 
         # stitch pose segments together
         return lietorch.cat(pose_list, 0)
@@ -1,7 +1,6 @@
 import torch
 import cv2
 import lietorch
-import droid_backends
 import time
 import argparse
 import numpy as np
@@ -53,7 +52,9 @@ def create_point_actor(points, colors):
 def droid_visualization(video, device="cuda:0"):
     """ DROID visualization frontend """
 
-    torch.cuda.set_device(device)
+    if torch.device(device).type == "cuda":
+        torch.cuda.set_device(device)
+
     droid_visualization.video = video
     droid_visualization.cameras = {}
     droid_visualization.points = {}
@@ -79,6 +80,7 @@ def droid_visualization(video, device="cuda:0"):
         with torch.no_grad():
 
             with video.get_lock():
+                video.sync()
                 t = video.counter.value 
                 dirty_index, = torch.where(video.dirty.clone())
                 dirty_index = dirty_index
@@ -93,13 +95,14 @@ def droid_visualization(video, device="cuda:0"):
             disps = torch.index_select(video.disps, 0, dirty_index)
             Ps = SE3(poses).inv().matrix().cpu().numpy()
 
-            images = torch.index_select(video.images, 0, dirty_index)
+            images = torch.index_select(video.images, 0, video.slots[dirty_index])
             images = images.cpu()[:,[2,1,0],3::8,3::8].permute(0,2,3,1) / 255.0
-            points = droid_backends.iproj(SE3(poses).inv().data, disps, video.intrinsics[0]).cpu()
+            backends = video.backends()
+            points = backends.iproj(SE3(poses).inv().data, disps, video.intrinsics[0]).cpu()
             points[..., :3] = points[..., :3] * 10
             thresh = droid_visualization.filter_thresh * torch.ones_like(disps.mean(dim=[1,2]))
             
-            count = droid_backends.depth_filter(
+            count = backends.depth_filter(
                 video.poses, video.disps, video.intrinsics[0], dirty_index, thresh)
 
             count = count.cpu()
@@ -0,0 +1,150 @@
+""" parity of the cpu correlation lookups with the cuda kernels in src/, the
+    reference implementations below are direct loop ports of the kernels """
+
+import math
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("lietorch")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "droid_slam"))
+import cpu_backends
+
+
+def corr_index_reference(volume, coords, r):
+    """ loop port of corr_index_forward_kernel in src/correlation_kernels.cu """
+    num, h1, w1, h2, w2 = volume.shape
+    rd = 2*r + 1
+    corr = torch.zeros(num, rd, rd, h1, w1, dtype=torch.float64)
+
+    for n in range(num):
+        for y in range(h1):
+            for x in range(w1):
+                x0 = coords[n,0,y,x].item()
+                y0 = coords[n,1,y,x].item()
+                dx = x0 - math.floor(x0)
+                dy = y0 - math.floor(y0)
+
+                for i in range(rd+1):
+                    for j in range(rd+1):
+                        x1 = math.floor(x0) - r + i
+                        y1 = math.floor(y0) - r + j
+                        if not (0 <= y1 < h2 and 0 <= x1 < w2):
+                            continue
+
+                        s = volume[n,y,x,y1,x1].item()
+                        if i > 0 and j > 0:
+                            corr[n,i-1,j-1,y,x] += s * dx * dy
+                        if i > 0 and j < rd:
+                            corr[n,i-1,j,y,x] += s * dx * (1-dy)
+                        if i < rd and j > 0:
+                            corr[n,i,j-1,y,x] += s * (1-dx) * dy
+                        if i < rd and j < rd:
+                            corr[n,i,j,y,x] += s * (1-dx) * (1-dy)
+
+    return corr
+
+
+def altcorr_reference(fmap1, fmap2, coords, r):
+    """ loop port of altcorr_forward_kernel in src/altcorr_kernel.cu """
+    B, N, H1, W1, _ = coords.shape
+    _, H2, W2, _ = fmap2.shape
+    rd = 2*r + 1
+    corr = torch.zeros(B, N, rd*rd, H1, W1, dtype=torch.float64)
+
+    for b in range(B):
+        for n in range(N):
+            for h1 in range(H1):
+                for w1 in range(W1):
+                    x2 = coords[b,n,h1,w1,0].item()
+                    y2 = coords[b,n,h1,w1,1].item()
+                    dx = x2 - math.floor(x2)
+                    dy = y2 - math.floor(y2)
+
+                    for iy in range(rd+1):
+                        for ix in range(rd+1):
+                            h2 = math.floor(y2) - r + iy
+                            w2 = math.floor(x2) - r + ix
+                            s = 0.0
+                            if 0 <= h2 < H2 and 0 <= w2 < W2:
+                                s = torch.dot(fmap1[b,h1,w1].double(), fmap2[b,h2,w2].double()).item()
+
+                            if iy > 0 and ix > 0:
+                                corr[b,n,(iy-1) + rd*(ix-1),h1,w1] += s * dy * dx
+                            if iy > 0 and ix < rd:
+                                corr[b,n,(iy-1) + rd*ix,h1,w1] += s * dy * (1-dx)
+                            if iy < rd and ix > 0:
+                                corr[b,n,iy + rd*(ix-1),h1,w1] += s * (1-dy) * dx
+                            if iy < rd and ix < rd:
+                                corr[b,n,iy + rd*ix,h1,w1] += s * (1-dy) * (1-dx)
+
+    return corr
+
+
+def random_coords(shape, ht, wd, r, generator):
+    """ fractional coordinates around the image, some windows partly or fully out of bounds """
+    x = torch.rand(shape, generator=generator) * (wd + 4*r) - 2*r
+    y = torch.rand(shape, generator=generator) * (ht + 4*r) - 2*r
+
+    x.view(-1)[0], y.view(-1)[0] = -50.25, 3.5
+    x.view(-1)[1], y.view(-1)[1] = 2.75, ht + 40.5
+    x.view(-1)[2], y.view(-1)[2] = -r - 0.5, -r - 0.5
+    x.view(-1)[3], y.view(-1)[3] = wd - 0.25, ht - 0.75
+    return x, y
+
+
+@pytest.mark.parametrize("radius", [1, 3])
+def test_corr_index_forward(radius):
+    g = torch.Generator().manual_seed(0)
+    num, h1, w1, h2, w2 = 2, 3, 5, 6, 7
+
+    volume = torch.randn(num, h1, w1, h2, w2, generator=g)
+    x, y = random_coords((num, h1, w1), h2, w2, radius, g)
+    coords = torch.stack([x, y], 1)
+
+    corr, = cpu_backends.corr_index_forward(volume, coords, radius)
+    expected = corr_index_reference(volume, coords, radius)
+
+    assert corr.shape == expected.shape
+    assert torch.allclose(corr.double(), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("radius", [1, 3])
+def test_altcorr_forward(radius):
+    g = torch.Generator().manual_seed(0)
+    B, N, H1, W1, H2, W2, C = 2, 2, 3, 4, 5, 6, 8
+
+    fmap1 = torch.randn(B, H1, W1, C, generator=g)
+    fmap2 = torch.randn(B, H2, W2, C, generator=g)
+    x, y = random_coords((B, N, H1, W1), H2, W2, radius, g)
+    coords = torch.stack([x, y], -1)
+
+    corr, = cpu_backends.altcorr_forward(fmap1, fmap2, coords, radius)
+    expected = altcorr_reference(fmap1, fmap2, coords, radius)
+
+    assert corr.shape == expected.shape
+    assert torch.allclose(corr.double(), expected, atol=1e-5)
+
+
+def test_channel_layout():
+    """ channels are x offset major, a response at (x+1, y) lands in channel r + rd*(r+1) """
+    r, ht, wd = 2, 5, 6
+    rd = 2*r + 1
+
+    volume = torch.zeros(1, 1, 1, ht, wd)
+    volume[0,0,0,2,3] = 1.0
+    coords = torch.as_tensor([2.0, 2.0]).view(1, 2, 1, 1)
+
+    corr, = cpu_backends.corr_index_forward(volume, coords, r)
+    assert corr[0,r+1,r,0,0] == 1.0 and corr.sum() == 1.0
+
+    fmap1 = torch.ones(1, 1, 1, 1)
+    fmap2 = torch.zeros(1, ht, wd, 1)
+    fmap2[0,2,3] = 1.0
+    coords = torch.as_tensor([2.0, 2.0]).view(1, 1, 1, 1, 2)
+
+    corr, = cpu_backends.altcorr_forward(fmap1, fmap2, coords, r)
+    assert corr[0,0,r + rd*(r+1),0,0] == 1.0 and corr.sum() == 1.0